@@ -1,224 +1,62 @@
-import tensorflow as tf
-import pickle
 from tkinter import *
 from tkinter import ttk, filedialog, messagebox
 import os
 import random
-from pydub import AudioSegment
-from pychord import Chord
-from midiutil import MIDIFile
 import tempfile
-import numpy as np
+import shutil
 import pygame
-
-def load_model_and_dictionaries(model_name):
-    model = tf.keras.models.load_model(f'{model_name}.h5')
-    
-    with open(f'{model_name}_chord_to_int.pkl', 'rb') as f:
-        chord_to_int = pickle.load(f)
-    with open(f'{model_name}_int_to_chord.pkl', 'rb') as f:
-        int_to_chord = pickle.load(f)
-    
-    return model, chord_to_int, int_to_chord
-
-options_without_any = ['C', 'Db', 'D', 'Eb', 'E', 
-                       'F', 'Gb', 'G', 'Ab', 'A', 
-                       'Bb', 'B', 'Cm', 'Dbm', 'Dm',
-                       'Ebm', 'Em', 'Fm', 'Gbm', 'Gm', 
-                       'Abm', 'Am', 'Bbm', 'Bm']
-
-def generate_chords(mood, start_chord, num_chords=3):
-    model_name = f"{mood}_model"
-    model, chord_to_int, int_to_chord = load_model_and_dictionaries(model_name)
-    
-    if start_chord not in chord_to_int:
-        start_chord = random.choice(options_without_any)
-    
-    sequence = [chord_to_int[start_chord]]
-    generated_chords = [start_chord]  
-
-    for _ in range(num_chords):
-        x_pred = np.array(sequence[-3:])[np.newaxis, :]
-        x_pred = np.pad(x_pred, ((0, 0), (max(0, 3-x_pred.shape[1]), 0)), mode='constant', constant_values=0)
-        prediction = model.predict(x_pred, verbose=0)[0]
-        
-        next_index = np.random.choice(range(len(prediction)), p=prediction)
-        generated_chords.append(int_to_chord[next_index])
-        sequence.append(next_index)
-
-    return generated_chords
-
-def chords_to_notes(chord_progression):
-    notes_of_chord_progression = []
-    for chord in chord_progression:
-        c = Chord(chord)
-        notes_of_chord_progression.append(c.components())
-    return notes_of_chord_progression
-
-def notes_to_midi_with_bass(chord_notes):
-    note_mapping = {
-        "C": 60, "Db": 61, "C#": 61, "D": 62, "Eb": 63, "D#": 63, "E": 64,
-        "F": 65, "Gb": 66, "F#": 66, "G": 67, "Ab": 68, "G#": 68, "A": 69,
-        "Bb": 70, "A#": 70, "B": 71, "Cb": 71, "Fb": 64
-    }
-
-    midi_chords = []
-    bass_notes = []
-    for chord in chord_notes:
-        midi_chord = [note_mapping[note] for note in chord]
-        midi_chords.append(midi_chord)
-        bass_notes.append(note_mapping[chord[0]] - 12) 
-    return midi_chords, bass_notes
-
-def generate_lead_melody(chords_notes, tempo, repetitions):
-    if not chords_notes:
-        return []
-
-    lead_notes = []
-    time_offset = 0  
-
-    for _ in range(repetitions):  
-        for chord in chords_notes:
-            if len(chord) < 3:
-                continue 
-
-            midi_notes = sorted(chord)  
-            midi_notes = [note + 12 for note in midi_notes]  
-
-            rhythm_pattern = [1, 1, 2]
-
-            note_time = time_offset 
-            for note, duration in zip(midi_notes, rhythm_pattern):
-                lead_notes.append((note, note_time, duration))
-                note_time += duration  
-
-            time_offset += 4  
-
-    return lead_notes
-
-def generate_midi_with_bass(notes_of_chord_progression, output_file, repeats, tempo, add_bass, add_lead):
-    chord_notes, bass_notes = notes_to_midi_with_bass(notes_of_chord_progression)
-    
-    if add_lead:
-        lead_melody_per_chord = [generate_lead_melody([ch], tempo, 1) for ch in chord_notes]
-    else:
-        lead_melody_per_chord = [] 
-    
-    midi = MIDIFile(3 if add_lead else (2 if add_bass else 1)) 
-
-    track_chords = 0
-    track_bass = 1 if add_bass else None
-    track_lead = 2 if add_lead else None
-    channel = 0
-    volume = 100
-    lead_volume = 110  
-
-    time = 0
-
-    midi.addTempo(track_chords, time, tempo)
-    if track_bass is not None:
-        midi.addTempo(track_bass, time, tempo)
-    if track_lead is not None:
-        midi.addTempo(track_lead, time, tempo)
-
-    for z in range(0, repeats * 16, 16):
-        for i, chord in enumerate(chord_notes):
-            for pitch in chord:
-                midi.addNote(track_chords, channel, pitch, i * 4 + z, 4, volume)
-
-    if track_bass is not None:
-        for z in range(0, repeats * 16, 16):
-            for i, bass in enumerate(bass_notes):
-                midi.addNote(track_bass, channel, bass, i * 4 + z, 4, volume)
-
-    if track_lead is not None:
-        for repeat_index in range(repeats):  
-            time_offset = repeat_index * 16 
-
-            for chord_index, chord_melody in enumerate(lead_melody_per_chord):
-                chord_start_time = time_offset + chord_index * 4  
-
-                for lead_note, relative_time, duration in chord_melody:
-                    absolute_time = chord_start_time + relative_time
-                    midi.addNote(track_lead, channel, lead_note, absolute_time, duration, lead_volume)
-
-    with open(output_file, "wb") as output_f:
-        midi.writeFile(output_f)
-
-def add_drums_to_audio(audio, drum_style, tempo, drum_volume=0.5):
-    if drum_style == "No":
-        return audio
-
-    if drum_style == "Rock":
-        kick = AudioSegment.from_file("sounds/rock_kick.wav")
-        snare = AudioSegment.from_file("sounds/rock_snare.wav")
-        hi_hat = AudioSegment.from_file("sounds/rock_hihat.wav")
-    elif drum_style == "Electronic":
-        kick = AudioSegment.from_file("sounds/electronic_kick.wav")
-        snare = AudioSegment.from_file("sounds/electronic_snare.wav")
-        hi_hat = AudioSegment.from_file("sounds/electronic_hihat.wav")
-
-
-    kick = kick - (1 - drum_volume) * 30  
-    snare = snare - (1 - drum_volume) * 30
-    hi_hat = hi_hat - (1 - drum_volume) * 30
-
-    beat_duration = 60000 / tempo
-    eighth_duration = beat_duration / 2
-
-    one_bar = AudioSegment.silent(duration=4 * beat_duration) 
-
-    one_bar = (
-        one_bar.overlay(kick, position=0)  
-        .overlay(snare, position=beat_duration)  
-        .overlay(kick, position=2 * beat_duration)  
-        .overlay(snare, position=3 * beat_duration) 
-    )
-
-    for i in range(0, 8):
-        one_bar = one_bar.overlay(hi_hat, position=i * eighth_duration)
-
-    drum_track = one_bar * (len(audio) // len(one_bar) + 1)
-
-    drum_track = drum_track[:len(audio)]
-
-    mixed_audio = audio.overlay(drum_track)
-    return mixed_audio
-
-def midi_to_mp3_with_drums(midi_file, soundfont, mp3_file, drum_style, tempo):
-    wav_file = mp3_file.replace('.mp3', '.wav')
-    os.system(f'fluidsynth -ni {soundfont} {midi_file} -F {wav_file} -r 44100')
-    audio = AudioSegment.from_wav(wav_file)
-    audio_with_drums = add_drums_to_audio(audio, drum_style, tempo)
-    audio_with_drums.export(mp3_file, format='mp3')
-
-    os.remove(wav_file)
-
-def soundfont_choose(sf_name):
-    if sf_name == 'Piano':
-        sf = 'sounds/GeneralUser_GS_v1.471.sf2'
-    elif sf_name == 'Marimba':
-        sf = 'sounds/marimba-deadstroke.sf2'
-    elif sf_name == 'Old video games':
-        sf = 'sounds/PICO-8_1.1.2.sf2'
-    return sf
+from makethemusic import model_registry, synth_backend
+from makethemusic.chord_generation import generate_distinct_chords
+from makethemusic.drum_mixer import drum_style_names
+from makethemusic.export import build_arrangement, render_arrangement, write_audio
+from makethemusic.midi_builder import write_midi
+from makethemusic.pipeline import soundfont_choose
+from makethemusic.playback import PlaybackEngine, default_sink
+from makethemusic.render_cache import RenderCache, render_key
+from makethemusic.render_worker import RenderWorker
+
+def play_file(mp3_file):
+    status_text.set("")
+    pygame.mixer.music.load(mp3_file)
+    pygame.mixer.music.play()
 
 def play_mp3():
-    generate_mp3()
-    if last_generated_mp3 and os.path.exists(last_generated_mp3):
-        pygame.mixer.music.load(last_generated_mp3)
-        pygame.mixer.music.play()
-    else:
+    if not last_generated_chords:
         messagebox.showerror("Error", "No MP3 file available to play.")
+        return
+    if playback_engine is None:
+        submit_render(on_done=play_file)
+        return
+    # Real-time preview: starts at once, no MP3 render
+    try:
+        settings = current_render_settings()
+    except ValueError:
+        messagebox.showerror("Error", "BPM and repetitions must be whole numbers.")
+        return
+    pygame.mixer.music.stop()
+    try:
+        playback_engine.play(last_generated_chords, **settings)
+    except OSError as e:
+        messagebox.showerror("Error", f"Playback failed: {e}")
 
 def stop_mp3():
+    if playback_engine is not None:
+        playback_engine.stop()
     pygame.mixer.music.stop()
 
-pygame.mixer.init()
+pygame.mixer.init(frequency=synth_backend.SAMPLE_RATE, size=-16, channels=synth_backend.CHANNELS, buffer=512)
+# The real-time engine needs FluidSynth in-process; without it Play falls back to rendering an MP3
+playback_engine = PlaybackEngine(default_sink()) if synth_backend.in_process_available() else None
+model_registry.register_model_dir()
+model_registry.warm_models(tables=True)
 last_generated_chords = []
+last_arrangement = (None, None)
+render_cache = RenderCache()
+pending_prerender = None
 root = Tk()
 root.title("MakeTheMusic")
 root.geometry("700x700")
+render_worker = RenderWorker(root)
 
 bg_image = None
 bg_label = None
@@ -239,7 +77,7 @@ header = LabelFrame(root, text="Sound", padx=10, pady=10)
 header.pack(fill="x", padx=10, pady=10)
 
 input_wrap = Frame(header)
-options_major_minor = ["happy", "sad"]
+options_major_minor = model_registry.available_moods() or ["happy", "sad"]
 value_inside = StringVar(root)
 value_inside.set(options_major_minor[0])
 dropdown_minor_major = ttk.Combobox(input_wrap, values=options_major_minor, state="readonly", textvariable=value_inside)
@@ -251,14 +89,21 @@ value_inside_n.set(options_chord[0])
 dropdown_chord = ttk.Combobox(input_wrap, values=options_chord, state="readonly", textvariable=value_inside_n)
 dropdown_chord.pack(side=LEFT)
 
+num_chords_var = IntVar(root, value=3)
+num_chords_spinbox = Spinbox(input_wrap, from_=1, to=64, width=5, textvariable=num_chords_var)
+num_chords_spinbox.pack(side=LEFT)
+
 input_wrap.pack()
 label_wrapper = Frame(header)
 Label(label_wrapper, text="Mood").pack(side=LEFT)
 Label(label_wrapper, text="First chord").pack(side=LEFT)
+Label(label_wrapper, text="Chords after the first").pack(side=LEFT)
 label_wrapper.pack()
 
 res_field_text = StringVar()
 res_field = Label(root, textvariable=res_field_text)
+status_text = StringVar()
+status_label = Label(root, textvariable=status_text)
 
 output_settings = LabelFrame(root, text="Output settings:")
 output_settings.pack_forget()
@@ -294,7 +139,7 @@ synth_options.bind("<<ComboboxSelected>>", lambda e: on_synthesizer_selected(syn
 drum_style_var = StringVar(root)
 drum_style_var.set("No")
 Label(output_settings, text="Add drums:").grid(row=3, column=0, sticky=W)
-drum_style_options = ttk.Combobox(output_settings, values=["No", "Rock", "Electronic"], state="readonly", textvariable=drum_style_var)
+drum_style_options = ttk.Combobox(output_settings, values=["No"] + drum_style_names(), state="readonly", textvariable=drum_style_var)
 drum_style_options.grid(row=3, column=1)
 
 bass_line_var = BooleanVar()
@@ -303,68 +148,157 @@ lead_melody_var = BooleanVar()
 Checkbutton(output_settings, text="Add a lead melody", variable=lead_melody_var).grid(row=5, columnspan=2, sticky=W)
 
 def on_generate():
-    global last_generated_chords
     mood = value_inside.get()
     selected_start_chord = value_inside_n.get()
     
     if selected_start_chord == 'Any':
         selected_start_chord = random.choice(options_chord[1:])
     
-    new_chords = generate_chords(mood, selected_start_chord)
-    
-    while new_chords == last_generated_chords:
-        new_chords = generate_chords(mood, selected_start_chord)
-    
+    try:
+        num_chords = num_chords_var.get()
+    except TclError:
+        num_chords = 0
+    if not 1 <= num_chords <= 64:
+        messagebox.showerror("Error", "The number of chords must be a whole number from 1 to 64.")
+        return
+    render_worker.submit(generate_progression, mood, selected_start_chord, num_chords, channel='generate',
+                         on_done=on_chords_generated, on_error=on_render_error, on_progress=show_progress)
+
+def generate_progression(job, mood, start_chord, num_chords):
+    job.progress("Generating chords")
+    return generate_distinct_chords(mood, start_chord, 1, num_chords, use_table=True)[0]
+
+def on_chords_generated(new_chords):
+    global last_generated_chords
     last_generated_chords = new_chords
     res_field_text.set(' '.join(new_chords))
     output_settings.pack(pady=10)
-    generate_mp3()
-    play_button.pack(side=LEFT, padx=10)
-    stop_button.pack(side=RIGHT, padx=10)
+    if playback_engine is not None:
+        playback_engine.preload(current_soundfont())
+        if playback_engine.playing:
+            playback_engine.update(chords=new_chords)
+        play_button.pack(side=LEFT, padx=10)
+        stop_button.pack(side=RIGHT, padx=10)
+    submit_render()
 
 def on_generate_midi():
     tempo = int(tempo_entry.get())
     repetitions = int(repetitions_entry.get())
-    notes = chords_to_notes(last_generated_chords)
     output_file = filedialog.asksaveasfilename(defaultextension=".mid", filetypes=[("MIDI files", "*.mid")])  
     if not output_file:
         return  
     add_bass = bass_line_var.get()
     add_lead = lead_melody_var.get()
-    generate_midi_with_bass(notes, output_file, repetitions, tempo, add_bass, add_lead)
+    write_midi(arrangement_for(last_generated_chords, tempo, repetitions, add_bass, add_lead)['midi'], output_file)
 
-def generate_mp3():
-    global last_generated_mp3
+def arrangement_for(chords, tempo, repetitions, add_bass, add_lead):
+    # The MIDI of the last render is reused by Save MIDI instead of being built again
+    global last_arrangement
+    key = (tuple(chords), tempo, repetitions, add_bass, add_lead)
+    if last_arrangement[0] != key:
+        last_arrangement = (key, build_arrangement(chords, tempo, repetitions, add_bass, add_lead))
+    return last_arrangement[1]
 
+def current_soundfont():
     if synth_var.get() == "Other":
-        soundfont = synth_var_custom.get()
-    else:
-        soundfont = soundfont_choose(synth_var.get())
+        return synth_var_custom.get()
+    return soundfont_choose(synth_var.get())
+
+def current_render_settings():
+    return {
+        'tempo': int(tempo_entry.get()),
+        'repetitions': int(repetitions_entry.get()),
+        'soundfont': current_soundfont(),
+        'drum_style': drum_style_var.get(),
+        'add_bass': bass_line_var.get(),
+        'add_lead': lead_melody_var.get(),
+    }
 
-    repetitions = int(repetitions_entry.get())
-    tempo = int(tempo_entry.get())
-    drum_style = drum_style_var.get()
-    
-    chords_notes = chords_to_notes(last_generated_chords)
+def render_mp3(job, chords, settings):
+    # Runs on a render worker thread; settings come from current_render_settings() on the UI thread
+    key = render_key(chords, **settings)
+    cached_mp3 = render_cache.get_path(key)
+    if cached_mp3:
+        return cached_mp3
 
-    add_bass = bass_line_var.get() 
-    add_lead = lead_melody_var.get()  
+    job.progress("Building MIDI")
+    temp_mp3 = tempfile.NamedTemporaryFile(suffix=".mp3", delete=False)
+    temp_mp3.close()
+    try:
+        arrangement = arrangement_for(chords, settings['tempo'], settings['repetitions'], settings['add_bass'],
+                                      settings['add_lead'])
+        job.progress("Synthesizing")
+        samples = render_arrangement(arrangement, settings['soundfont'], settings['drum_style'])['mix']
+        job.progress("Encoding MP3")
+        write_audio(samples, temp_mp3.name, 'mp3')
+        job.check()
+        return render_cache.put_file(key, temp_mp3.name)
+    finally:
+        if os.path.exists(temp_mp3.name):
+            os.remove(temp_mp3.name)
+
+def submit_render(on_done=None, channel='render'):
+    try:
+        settings = current_render_settings()
+    except ValueError:
+        messagebox.showerror("Error", "BPM and repetitions must be whole numbers.")
+        return None
+    return render_worker.submit(render_mp3, list(last_generated_chords), settings, channel=channel,
+                                on_done=on_done or on_render_done, on_error=on_render_error, on_progress=show_progress)
+
+def on_render_done(mp3_file):
+    status_text.set("")
+    play_button.pack(side=LEFT, padx=10)
+    stop_button.pack(side=RIGHT, padx=10)
 
-    with tempfile.NamedTemporaryFile(suffix=".mid", delete=False) as temp_midi:
-        generate_midi_with_bass(chords_notes, temp_midi.name, repetitions, tempo, add_bass, add_lead)
+def on_render_error(error):
+    status_text.set("")
+    messagebox.showerror("Error", f"Rendering failed: {error}")
+
+def show_progress(message, fraction=None):
+    status_text.set(f"{message}...")
+
+def on_settings_changed(*args):
+    # Drop the render for the old settings and start a fresh one once the user stops typing
+    global pending_prerender
+    render_worker.cancel('render')
+    status_text.set("")
+    if playback_engine is not None and playback_engine.playing:
+        # Heard from the next bar on
+        try:
+            playback_engine.update(**current_render_settings())
+        except ValueError:
+            pass
+    if pending_prerender is not None:
+        root.after_cancel(pending_prerender)
+        pending_prerender = None
+    if last_generated_chords:
+        pending_prerender = root.after(400, prerender)
+
+def prerender():
+    global pending_prerender
+    pending_prerender = None
+    try:
+        current_render_settings()
+    except ValueError:
+        return
+    submit_render()
 
-        temp_mp3 = tempfile.NamedTemporaryFile(suffix=".mp3", delete=False)
-        last_generated_mp3 = temp_mp3.name
+def save_mp3_file():
+    if not last_generated_chords:
+        return
+    save_path = filedialog.asksaveasfilename(defaultextension=".mp3", filetypes=[("MP3 files", "*.mp3")])
+    if save_path:
+        submit_render(on_done=lambda mp3_file: copy_render(mp3_file, save_path), channel='save')
 
-        midi_to_mp3_with_drums(temp_midi.name, soundfont, last_generated_mp3, drum_style, tempo)
-        os.remove(temp_midi.name)
+def copy_render(mp3_file, save_path):
+    status_text.set("")
+    shutil.copyfile(mp3_file, save_path)
 
-def save_mp3_file():
-    if last_generated_mp3:
-        save_path = filedialog.asksaveasfilename(defaultextension=".mp3", filetypes=[("MP3 files", "*.mp3")])
-        if save_path:
-            os.rename(last_generated_mp3, save_path)
-            last_generated_mp3 = save_path  
+for settings_var in (synth_var, synth_var_custom, drum_style_var, bass_line_var, lead_melody_var):
+    settings_var.trace_add('write', on_settings_changed)
+tempo_entry.bind('<KeyRelease>', on_settings_changed)
+repetitions_entry.bind('<KeyRelease>', on_settings_changed)
 
 set_background("background.png") 
 
@@ -380,6 +314,7 @@ play_button.pack_forget()
 stop_button.pack_forget()
 
 res_field.pack(padx=50, pady=5)
+status_label.pack()
 Button(output_settings, text="Save MIDI", command=on_generate_midi).grid(row=6, column=0, pady=10)
 Button(output_settings, text="Save MP3", command=save_mp3_file).grid(row=6, column=1, pady=10)
 
@@ -413,3 +348,4 @@ tutorial_button = Button(bottom_frame, text="Tutorial", width=15, command=lambda
 tutorial_button.pack(side="right", padx=10)
 
 root.mainloop()
+render_worker.shutdown()
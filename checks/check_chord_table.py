@@ -0,0 +1,44 @@
+import os
+import sys
+
+from pychord import Chord
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from makethemusic.chord_table import CHORD_LOW, get_chord_table, note_pitch_class, resolve_progression
+from makethemusic.model_registry import get_model, register_model_dir
+
+# ChordTable precomputes what pychord used to work out for every chord of every render. This compares
+# every precomputed row with pychord's components, and the 'fixed' voicing of every chord the models
+# know (plus a few slash chords, which go through pychord) with the note names pychord gives.
+#   python checks/check_chord_table.py
+SLASH_CHORDS = ['C/E', 'Am/G', 'F/C', 'G7/B', 'Dm7/C']
+
+
+def pychord_pitches(name):
+    # The old path: pychord note names, each put in the octave starting at CHORD_LOW, bass an octave lower
+    notes = Chord(name).components()
+    return [CHORD_LOW + note_pitch_class(note) for note in notes], CHORD_LOW - 12 + note_pitch_class(notes[0])
+
+
+def main():
+    table = get_chord_table()
+    for row, name in enumerate(table.names):
+        expected = Chord(name).components(visible=False)
+        if table.semitones[row, :table.sizes[row]].tolist() != expected:
+            print(f"{name}: table has {table.semitones[row, :table.sizes[row]].tolist()}, pychord {expected}")
+            return 1
+
+    vocabulary = sorted({chord for mood in register_model_dir() for chord in get_model(mood)[1]})
+    vocabulary += SLASH_CHORDS
+    pitches, sizes, bass = resolve_progression(vocabulary)
+    for name, row, size, low in zip(vocabulary, pitches.tolist(), sizes.tolist(), bass.tolist()):
+        if (row[:size], low) != pychord_pitches(name):
+            print(f"{name}: table voices {row[:size]} over {low}, pychord {pychord_pitches(name)}")
+            return 1
+    print(f"{len(table.names)} table rows and {len(vocabulary)} model and slash chords match pychord")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
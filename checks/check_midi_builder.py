@@ -0,0 +1,60 @@
+import io
+import os
+import random
+import sys
+
+from midiutil import MIDIFile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from makethemusic.chord_table import progression_to_midi
+from makethemusic.pipeline import generate_lead_melody, generate_midi_from_chords
+
+# midi_builder writes the bytes midiutil would, without adding notes one by one. It relies on every note
+# ending inside its repetition and on midiutil's event order; this compares the two on random arrangements.
+#   python checks/check_midi_builder.py [cases]
+VOCABULARY = ['C', 'Am', 'F', 'G', 'Dm', 'Em', 'E', 'A', 'D', 'Bb', 'Eb', 'Ab', 'Db', 'F#', 'C#m', 'Bm', 'Gm',
+              'Fm', 'Cm', 'G7', 'Cmaj7', 'Dm7', 'Bdim', 'Caug', 'Dsus4', 'E9', 'F13', 'Gbm']
+TEMPOS = [60, 97, 120, 133, 311]
+
+
+def midiutil_midi(chords, repeats, tempo, add_bass, add_lead):
+    # The addNote loop the program used before midi_builder
+    chord_notes, bass_notes = progression_to_midi(chords)
+    midi = MIDIFile(3 if add_lead else (2 if add_bass else 1))
+    tracks = [0] + ([1] if add_bass else []) + ([2] if add_lead else [])
+    for track in tracks:
+        midi.addTempo(track, 0, tempo)
+    block = len(chord_notes) * 4
+    for z in range(0, repeats * block, block):
+        for i, chord in enumerate(chord_notes):
+            for pitch in chord:
+                midi.addNote(0, 0, pitch, i * 4 + z, 4, 100)
+    if add_bass:
+        for z in range(0, repeats * block, block):
+            for i, bass in enumerate(bass_notes):
+                midi.addNote(1, 0, bass, i * 4 + z, 4, 100)
+    if add_lead:
+        for z in range(0, repeats * block, block):
+            for i, chord in enumerate(chord_notes):
+                for pitch, t, duration in generate_lead_melody([chord], tempo, 1):
+                    midi.addNote(2, 0, pitch, z + i * 4 + t, duration, 110)
+    out = io.BytesIO()
+    midi.writeFile(out)
+    return out.getvalue()
+
+
+def main(cases=300, seed=1):
+    rng = random.Random(seed)
+    for case in range(cases):
+        chords = rng.choices(VOCABULARY, k=rng.randint(1, 6))
+        args = (rng.randint(0, 5), rng.choice(TEMPOS), rng.random() < 0.5, rng.random() < 0.5)
+        if generate_midi_from_chords(chords, None, *args) != midiutil_midi(chords, *args):
+            print(f"Case {case} differs: chords={chords} repeats, tempo, bass, lead={args}")
+            return 1
+    print(f"{cases} arrangements byte-identical to midiutil")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*map(int, sys.argv[1:2])))
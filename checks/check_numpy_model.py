@@ -0,0 +1,48 @@
+import os
+import pickle
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from makethemusic.model_bundle import BUNDLE_EXTENSION, load_bundle
+from makethemusic.model_registry import model_path, register_model_dir
+from makethemusic.numpy_model import load_npz_model
+
+# The chord models run on NumPy from <mood>_model.npz and .mtm; this compares both with the Keras model in
+# <mood>_model.h5 on random contexts, and the bundle's vocabulary with the pickles. Needs TensorFlow.
+#   python checks/check_numpy_model.py [contexts]
+CONTEXT_LENGTHS = (1, 3, 8)
+ATOL = 1e-5
+
+
+def main(contexts=256, seed=1):
+    import tensorflow as tf
+
+    rng = np.random.default_rng(seed)
+    moods = register_model_dir()
+    for mood in moods:
+        base = model_path(mood)
+        keras_model = tf.keras.models.load_model(f'{base}.h5')
+        models = {'.npz': load_npz_model(f'{base}.npz')}
+        if os.path.exists(f'{base}{BUNDLE_EXTENSION}'):
+            models[BUNDLE_EXTENSION], chord_to_int, _ = load_bundle(f'{base}{BUNDLE_EXTENSION}')
+            with open(f'{base}_chord_to_int.pkl', 'rb') as f:
+                if pickle.load(f) != chord_to_int:
+                    print(f"{mood}: {BUNDLE_EXTENSION} vocabulary differs from {base}_chord_to_int.pkl")
+                    return 1
+        for length in CONTEXT_LENGTHS:
+            x = rng.integers(0, keras_model.output_shape[-1], size=(contexts, length))
+            expected = keras_model.predict(x, verbose=0)
+            for ext, model in models.items():
+                difference = np.abs(model.predict(x) - expected).max()
+                if difference > ATOL:
+                    print(f"{mood}{ext}: predictions differ from Keras by {difference:.2e} on length {length}")
+                    return 1
+    print(f"{len(moods)} moods match Keras to within {ATOL} on {contexts} contexts of length {CONTEXT_LENGTHS}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*map(int, sys.argv[1:2])))
@@ -0,0 +1,141 @@
+import csv
+import json
+import os
+import random
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .chord_generation import generate_chords_batch
+from .export import AUDIO_FORMATS, MIDI_FORMAT, build_arrangement, export_track
+from .midi_builder import write_midi
+from .pipeline import soundfont_choose
+from .streaming import export_stream, stream_arrangement
+
+JOB_DEFAULTS = {
+    'mood': 'happy',
+    'start_chord': 'Any',
+    'num_chords': 3,
+    'tempo': 120,
+    'repetitions': 1,
+    'synth': 'Piano',
+    'drums': 'No',
+    'drum_volume': 0.5,
+    'bass': False,
+    'lead': False,
+}
+
+
+def load_manifest(path):
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if ext == '.csv':
+            return [dict(row) for row in csv.DictReader(f)]
+        if ext == '.jsonl':
+            return [json.loads(line) for line in f if line.strip()]
+        data = json.load(f)
+    return data['jobs'] if isinstance(data, dict) else data
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 'on')
+    return bool(value)
+
+
+def normalize_job(job, index):
+    # Fills defaults and undoes the all-strings typing of CSV manifests
+    job = {**JOB_DEFAULTS, **{k: v for k, v in job.items() if v not in (None, '')}}
+    job['name'] = str(job.get('name') or f'track_{index:05d}')
+    job['num_chords'] = int(job['num_chords'])
+    job['tempo'] = int(job['tempo'])
+    job['repetitions'] = int(job['repetitions'])
+    job['drum_volume'] = float(job['drum_volume'])
+    job['bass'] = _as_bool(job['bass'])
+    job['lead'] = _as_bool(job['lead'])
+    if isinstance(job.get('chords'), str):
+        job['chords'] = job['chords'].split()
+    return job
+
+
+def assign_chords(jobs, seed=None):
+    # Jobs without explicit chords get them from one batched generate call per (mood, length)
+    rng = np.random.default_rng(seed)
+    if seed is not None:
+        random.seed(seed)
+    groups = {}
+    for job in jobs:
+        if not job.get('chords'):
+            groups.setdefault((job['mood'], job['num_chords']), []).append(job)
+    for (mood, num_chords), group in groups.items():
+        progressions = generate_chords_batch(mood, [job['start_chord'] for job in group], len(group), num_chords, rng)
+        for job, chords in zip(group, progressions):
+            job['chords'] = chords
+
+
+def render_job(job, output_dir, formats, stems=False, bitrate=None):
+    started = time.perf_counter()
+    base = os.path.join(output_dir, job['name'])
+    files = []
+    audio_formats = [fmt for fmt in formats if fmt in AUDIO_FORMATS]
+
+    if stems:
+        # Rendered once per part into memory; every format of the mix and of each stem is then written at once
+        files = export_track(job['chords'], soundfont_choose(job['synth']), base, formats, job['tempo'],
+                             job['repetitions'], job['drums'], job['bass'], job['lead'], job['drum_volume'],
+                             stems=True, bitrate=bitrate)
+        return {'name': job['name'], 'chords': job['chords'], 'files': files,
+                'seconds': round(time.perf_counter() - started, 3)}
+
+    # One arrangement feeds both the .mid and the audio renderer
+    arrangement = build_arrangement(job['chords'], job['tempo'], job['repetitions'], job['bass'], job['lead'])
+    if MIDI_FORMAT in formats:
+        files.append(f'{base}.mid')
+        write_midi(arrangement['midi'], files[-1])
+    if audio_formats:
+        # Streamed bar by bar into every encoder at once, so memory does not grow with repetitions
+        outputs = {fmt: f'{base}.{fmt}' for fmt in audio_formats}
+        blocks = stream_arrangement(arrangement, soundfont_choose(job['synth']), job['drums'], job['drum_volume'])
+        export_stream(blocks, outputs, bitrate=bitrate)
+        files += list(outputs.values())
+    return {'name': job['name'], 'chords': job['chords'], 'files': files,
+            'seconds': round(time.perf_counter() - started, 3)}
+
+
+def _render_job_safely(job, output_dir, formats, stems, bitrate):
+    try:
+        return render_job(job, output_dir, formats, stems, bitrate)
+    except Exception as e:
+        return {'name': job['name'], 'chords': job.get('chords'), 'error': f'{type(e).__name__}: {e}',
+                'traceback': traceback.format_exc()}
+
+
+def run_batch(manifest, output_dir, formats=(MIDI_FORMAT, 'mp3'), workers=None, seed=None, log=print, stems=False,
+              bitrate=None):
+    # manifest is a path or a list of job dicts; results are also written to <output_dir>/results.jsonl.
+    # stems=True also writes <name>_chords/_bass/_lead/_drums in every audio format.
+    unknown = [fmt for fmt in formats if fmt != MIDI_FORMAT and fmt not in AUDIO_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown output formats: {', '.join(unknown)}")
+    if isinstance(manifest, str):
+        manifest = load_manifest(manifest)
+    jobs = [normalize_job(job, i) for i, job in enumerate(manifest)]
+    assign_chords(jobs, seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_render_job_safely, job, output_dir, list(formats), stems, bitrate) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if log is not None:
+                status = result['error'] if 'error' in result else f"{' '.join(result['chords'])} ({result['seconds']}s)"
+                log(f"[{len(results)}/{len(jobs)}] {result['name']}: {status}")
+
+    with open(os.path.join(output_dir, 'results.jsonl'), 'w', encoding='utf-8') as f:
+        for result in sorted(results, key=lambda r: r['name']):
+            f.write(json.dumps({k: v for k, v in result.items() if k != 'traceback'}) + '\n')
+    return results
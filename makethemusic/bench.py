@@ -0,0 +1,204 @@
+import itertools
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import model_registry, synth_backend
+from .chord_generation import generate_chords_batch
+from .drum_mixer import drum_style_names, mix_drums
+from .export import MIX, build_arrangement, export_buffers, export_targets, render_arrangement
+from .pipeline import soundfont_choose, timed_stage
+from .synth_backend import CHANNELS, SAMPLE_RATE
+
+STAGES = ('load_model', 'generate', 'resolve_chords', 'midi', 'synth', 'drums', 'export')
+PERCENTILES = (50, 90, 99)
+FLAG_SETS = {'none': (False, False), 'bass': (True, False), 'lead': (False, True), 'both': (True, True)}
+BENCH_DEFAULTS = {
+    'mood': 'happy',
+    'start_chord': 'Any',
+    'num_chords': 3,
+    'tempos': (90, 120, 160),
+    'repetitions': (1, 4, 16),
+    'drum_styles': None,
+    'flags': ('none', 'bass', 'lead', 'both'),
+    'runs': 5,
+    'fmt': 'mp3',
+    'synth': 'Piano',
+    'seed': 0,
+}
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+def summarize(seconds):
+    ms = np.asarray(seconds, dtype=np.float64) * 1000
+    summary = {'count': len(ms), 'mean_ms': round(float(ms.mean()), 3), 'min_ms': round(float(ms.min()), 3),
+               'max_ms': round(float(ms.max()), 3)}
+    for p, value in zip(PERCENTILES, np.percentile(ms, PERCENTILES)):
+        summary[f'p{p}_ms'] = round(float(value), 3)
+    return summary
+
+
+def synth_unavailable(soundfont):
+    # Why the synth stage can't run here, or None. Without it the later stages run on silence of the same length.
+    if not os.path.exists(soundfont):
+        return f"SoundFont not found: {soundfont}"
+    if not synth_backend.in_process_available() and shutil.which('fluidsynth') is None:
+        return "neither pyfluidsynth nor the fluidsynth command is available"
+    return None
+
+
+def export_format(fmt):
+    # The format the export stage really writes here: WAV when fmt needs ffmpeg and it is missing
+    if fmt != 'wav' and shutil.which('ffmpeg') is None and shutil.which('avconv') is None:
+        return 'wav'
+    return fmt
+
+
+def stage_summaries(times, fmt):
+    # The export summary records the format it was measured with
+    stages = {stage: summarize(times[stage]) for stage in STAGES if stage in times}
+    if 'export' in stages:
+        stages['export']['format'] = fmt
+    return stages
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'in_process_synth': synth_backend.in_process_available(),
+    }
+
+
+def run_benchmark(log=print, **options):
+    # Runs generate -> MIDI -> synth -> drums -> export `runs` times for every combination of tempo,
+    # repetitions, drum style and bass/lead flags, and returns the timings as a JSON-ready dict
+    options = {**BENCH_DEFAULTS, **options}
+    mood = options['mood']
+    drum_styles = options['drum_styles'] or ['No'] + drum_style_names()
+    soundfont = soundfont_choose(options['synth'])
+    skipped = {'synth': synth_unavailable(soundfont)}
+    fmt = export_format(options['fmt'])
+    if fmt != options['fmt']:
+        log(f"ffmpeg is needed for {options['fmt']}; exporting {fmt} instead")
+    rng = np.random.default_rng(options['seed'])
+
+    all_times = {}
+
+    def record_all(stage, seconds):
+        all_times.setdefault(stage, []).append(seconds)
+
+    if mood not in model_registry.register_model_dir():
+        raise ValueError(f"No model for mood: {mood}")
+    for _ in range(options['runs']):
+        with timed_stage(record_all, 'load_model'):
+            model_registry.load_model_and_dictionaries(model_registry.model_path(mood))
+    model_registry.get_model(mood)
+
+    combinations = []
+    tracks = 0
+    audio_seconds = 0.0
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as output_dir:
+        targets = export_targets(os.path.join(output_dir, 'track'), [fmt])
+        for tempo, repetitions, drum_style, flags in itertools.product(options['tempos'], options['repetitions'],
+                                                                       drum_styles, options['flags']):
+            add_bass, add_lead = FLAG_SETS[flags]
+            times = {}
+
+            def record(stage, seconds):
+                times.setdefault(stage, []).append(seconds)
+                record_all(stage, seconds)
+
+            for _ in range(options['runs']):
+                with timed_stage(record, 'generate'):
+                    chords = generate_chords_batch(mood, options['start_chord'], 1, options['num_chords'], rng=rng)[0]
+                # The same calls the GUI, batch and export_track make, timed through their instrument hooks
+                arrangement = build_arrangement(chords, tempo, repetitions, add_bass, add_lead, instrument=record)
+                if skipped['synth'] is None:
+                    buffers = render_arrangement(arrangement, soundfont, drum_style, instrument=record)
+                else:
+                    frames = int(round(len(chords) * 4 * repetitions * 60 / tempo * SAMPLE_RATE))
+                    with timed_stage(record, 'drums'):
+                        buffers = {MIX: mix_drums(np.zeros((frames, CHANNELS), dtype=np.int16), drum_style, tempo)}
+                export_buffers(buffers, targets, instrument=record)
+                tracks += 1
+                audio_seconds += len(buffers[MIX]) / SAMPLE_RATE
+
+            combinations.append({
+                'tempo': tempo, 'repetitions': repetitions, 'drum_style': drum_style,
+                'bass': add_bass, 'lead': add_lead, 'runs': options['runs'],
+                'stages': stage_summaries(times, fmt),
+                'peak_rss_mb': peak_rss_mb(),
+            })
+            total = sum(summary['mean_ms'] for summary in combinations[-1]['stages'].values())
+            log(f"{tempo} BPM x{repetitions} drums={drum_style} {flags}: {total:.1f} ms per track")
+    wall_seconds = time.perf_counter() - started
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'options': {**options, 'drum_styles': drum_styles, 'fmt': fmt},
+        'skipped': {stage: reason for stage, reason in skipped.items() if reason},
+        'stages': stage_summaries(all_times, fmt),
+        'throughput': {
+            'tracks': tracks,
+            'wall_seconds': round(wall_seconds, 3),
+            'tracks_per_second': round(tracks / wall_seconds, 3),
+            'audio_seconds_per_second': round(audio_seconds / wall_seconds, 3),
+        },
+        'peak_rss_mb': peak_rss_mb(),
+        'combinations': combinations,
+    }
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline, results, percentile=50):
+    # One line per stage: baseline -> current latency at the given percentile
+    key = f'p{percentile}_ms'
+    lines = []
+    for stage in STAGES:
+        old = baseline['stages'].get(stage, {}).get(key)
+        new = results['stages'].get(stage, {}).get(key)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        line = f"{stage:>15}: {old:10.3f} -> {new:10.3f} ms ({change:+.1f}%)"
+        old_fmt = baseline['stages'][stage].get('format')
+        new_fmt = results['stages'][stage].get('format')
+        if old_fmt and new_fmt and old_fmt != new_fmt:
+            line += f", {old_fmt} -> {new_fmt}"
+        lines.append(line)
+    old_rate = baseline['throughput']['tracks_per_second']
+    new_rate = results['throughput']['tracks_per_second']
+    lines.append(f"{'tracks/s':>15}: {old_rate:10.3f} -> {new_rate:10.3f}")
+    return lines
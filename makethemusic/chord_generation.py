@@ -0,0 +1,189 @@
+import random
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import model_registry
+from .transition_table import CONTEXT_LENGTH
+
+options_without_any = ['C', 'Db', 'D', 'Eb', 'E',
+                       'F', 'Gb', 'G', 'Ab', 'A',
+                       'Bb', 'B', 'Cm', 'Dbm', 'Dm',
+                       'Ebm', 'Em', 'Fm', 'Gbm', 'Gm',
+                       'Abm', 'Am', 'Bbm', 'Bm']
+
+RECENT_HISTORY_SIZE = 16
+
+_recent_progressions = {}
+_recent_lock = threading.Lock()
+
+
+def sample_rows(probabilities, rng=None):
+    # Draws one index per row of a (batch, num_chords) probability matrix with a single uniform per row
+    rng = rng or np.random
+    cdf = np.cumsum(probabilities, axis=1)
+    u = rng.random((cdf.shape[0], 1)) * cdf[:, -1:]
+    indices = (cdf <= u).sum(axis=1)
+    return np.minimum(indices, cdf.shape[1] - 1)
+
+
+def context_window(sequences):
+    # Last CONTEXT_LENGTH ids of every row, left-padded with 0 exactly like the single-sequence path
+    window = sequences[:, -CONTEXT_LENGTH:]
+    missing = CONTEXT_LENGTH - window.shape[1]
+    if missing > 0:
+        window = np.pad(window, ((0, 0), (missing, 0)), mode='constant', constant_values=0)
+    return window
+
+
+def resolve_start_chords(start_chord, n, chord_to_int):
+    if isinstance(start_chord, str) or start_chord is None:
+        start_chords = [start_chord] * n
+    else:
+        start_chords = list(start_chord)
+        if len(start_chords) != n:
+            raise ValueError(f"Expected {n} start chords, got {len(start_chords)}")
+
+    fallback = [c for c in options_without_any if c in chord_to_int] or sorted(chord_to_int)
+    return [c if c in chord_to_int else random.choice(fallback) for c in start_chords]
+
+
+def generate_chord_ids_batch(model, start_ids, num_chords=3, rng=None, stateful=False):
+    sequences = np.zeros((len(start_ids), num_chords + 1), dtype=np.int64)
+    sequences[:, 0] = start_ids
+
+    if stateful and hasattr(model, 'step'):
+        # Prime on the padded start window, then feed each sampled chord through one cell update.
+        # Unlike the sliding window, the state keeps the whole progression, not just the last 3 chords.
+        state = model.initial_state(len(sequences))
+        for ids in context_window(sequences[:, :1]).T:
+            prediction, state = model.step(ids, state)
+        for t in range(1, num_chords + 1):
+            sequences[:, t] = sample_rows(prediction, rng)
+            if t < num_chords:
+                prediction, state = model.step(sequences[:, t], state)
+        return sequences
+
+    for t in range(1, num_chords + 1):
+        prediction = model.predict(context_window(sequences[:, :t]), verbose=0)
+        sequences[:, t] = sample_rows(prediction, rng)
+    return sequences
+
+
+def generate_chords_batch(mood, start_chord, n, num_chords=3, rng=None, stateful=False, use_table=False):
+    # start_chord may be one chord for every row or a list of n chords; unknown chords ('Any') are randomised per row
+    model, chord_to_int, int_to_chord = model_registry.get_model(mood)
+    if use_table and not stateful:
+        model = model_registry.get_transition_table(mood)
+    start_chords = resolve_start_chords(start_chord, n, chord_to_int)
+
+    sequences = generate_chord_ids_batch(model, [chord_to_int[c] for c in start_chords], num_chords, rng, stateful)
+
+    vocabulary = np.array([int_to_chord[i] for i in range(len(int_to_chord))], dtype=object)
+    progressions = vocabulary[sequences[:, 1:]].tolist()
+    return [[start] + chords for start, chords in zip(start_chords, progressions)]
+
+
+def generate_chords(mood, start_chord, num_chords=3, stateful=False, use_table=False):
+    return generate_chords_batch(mood, start_chord, 1, num_chords, stateful=stateful, use_table=use_table)[0]
+
+
+def _log1mexp(a):
+    # log(1 - exp(a)) for a <= 0, accurate on both ends of the range
+    with np.errstate(divide='ignore'):
+        return np.where(a > -0.693, np.log(-np.expm1(a)), np.log1p(-np.exp(a)))
+
+
+def _truncated_gumbel(parent_scores, child_log_probs, rng):
+    # Perturbs every child with a Gumbel and shifts each row so its maximum equals the parent's score
+    with np.errstate(invalid='ignore', over='ignore'):
+        g = child_log_probs + rng.gumbel(size=child_log_probs.shape)
+        z = g.max(axis=1, keepdims=True)
+        v = parent_scores[:, np.newaxis] - g + _log1mexp(g - z)
+        scores = parent_scores[:, np.newaxis] - np.maximum(v, 0) - np.log1p(np.exp(-np.abs(v)))
+    scores[~np.isfinite(g)] = -np.inf
+    return scores
+
+
+def sample_distinct_ids(model, start_id, k, num_chords=3, exclude=(), rng=None):
+    # Stochastic beam search: k progressions drawn without replacement from the model's sequence
+    # distribution, one forward pass per timestep. Progressions in exclude (id tuples starting with
+    # start_id) are masked at the last step; the beam is widened by len(exclude) before that so the
+    # masked ones cannot crowd out valid prefixes.
+    rng = rng or np.random
+    excluded_next = {}
+    for progression in exclude:
+        excluded_next.setdefault(tuple(progression[:-1]), []).append(progression[-1])
+
+    sequences = np.array([[start_id]], dtype=np.int64)
+    log_probs = np.zeros(1)
+    scores = np.zeros(1)
+    for t in range(1, num_chords + 1):
+        probabilities = np.asarray(model.predict(context_window(sequences), verbose=0), dtype=np.float64)
+        if t == num_chords:
+            for row, prefix in enumerate(sequences):
+                probabilities[row, excluded_next.get(tuple(prefix.tolist()), [])] = 0
+        with np.errstate(divide='ignore'):
+            child_log_probs = log_probs[:, np.newaxis] + np.log(probabilities)
+        child_scores = _truncated_gumbel(scores, child_log_probs, rng).ravel()
+
+        width = k if t == num_chords else k + len(exclude)
+        candidates = np.flatnonzero(np.isfinite(child_scores))
+        chosen = candidates[np.argsort(-child_scores[candidates], kind='stable')[:width]]
+        parents, next_ids = np.divmod(chosen, probabilities.shape[1])
+
+        sequences = np.concatenate([sequences[parents], next_ids[:, np.newaxis]], axis=1)
+        log_probs = child_log_probs.ravel()[chosen]
+        scores = child_scores[chosen]
+    return sequences
+
+
+def recent_progressions(mood, start_chord):
+    with _recent_lock:
+        return list(_recent_progressions.get((mood, start_chord), ()))
+
+
+def remember_progressions(mood, start_chord, progressions, history_size=RECENT_HISTORY_SIZE):
+    with _recent_lock:
+        history = _recent_progressions.setdefault((mood, start_chord), OrderedDict())
+        for progression in progressions:
+            history[tuple(progression)] = None
+            history.move_to_end(tuple(progression))
+        while len(history) > history_size:
+            history.popitem(last=False)
+
+
+def forget_progressions(mood=None, start_chord=None):
+    with _recent_lock:
+        for key in list(_recent_progressions):
+            if mood in (None, key[0]) and start_chord in (None, key[1]):
+                del _recent_progressions[key]
+
+
+def generate_distinct_chords(mood, start_chord, k=1, num_chords=3, rng=None, use_table=False,
+                             avoid_recent=True, history_size=RECENT_HISTORY_SIZE):
+    # Returns up to k different progressions that also differ from the last history_size ones
+    # generated for this (mood, start chord). Fewer than k come back only when the model cannot
+    # produce k distinct progressions of this length at all.
+    model, chord_to_int, int_to_chord = model_registry.get_model(mood)
+    if use_table:
+        model = model_registry.get_transition_table(mood)
+    start_chord = resolve_start_chords(start_chord, 1, chord_to_int)[0]
+
+    exclude = []
+    if avoid_recent:
+        for progression in recent_progressions(mood, start_chord):
+            if len(progression) == num_chords + 1 and all(c in chord_to_int for c in progression):
+                exclude.append([chord_to_int[c] for c in progression])
+
+    sequences = sample_distinct_ids(model, chord_to_int[start_chord], k, num_chords, exclude, rng)
+    if len(sequences) < k and exclude:
+        # The history covers too much of the space; start the history over instead of spinning
+        forget_progressions(mood, start_chord)
+        sequences = sample_distinct_ids(model, chord_to_int[start_chord], k, num_chords, (), rng)
+
+    progressions = [[int_to_chord[i] for i in row] for row in sequences.tolist()]
+    if avoid_recent:
+        remember_progressions(mood, start_chord, progressions, history_size)
+    return progressions
@@ -0,0 +1,121 @@
+import threading
+from functools import lru_cache
+
+import numpy as np
+from pychord import Chord
+
+NOTE_LETTERS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+ACCIDENTALS = {'': 0, 'b': -1, '#': 1, 'bb': -2, '##': 2}
+
+# Semitones above the root, in the order pychord lists the components
+QUALITIES = {
+    '': (0, 4, 7), 'm': (0, 3, 7), 'dim': (0, 3, 6), 'aug': (0, 4, 8), '5': (0, 7),
+    'sus2': (0, 2, 7), 'sus4': (0, 5, 7), 'sus': (0, 5, 7), '6': (0, 4, 7, 9), 'm6': (0, 3, 7, 9),
+    '7': (0, 4, 7, 10), 'maj7': (0, 4, 7, 11), 'M7': (0, 4, 7, 11), 'm7': (0, 3, 7, 10), 'mM7': (0, 3, 7, 11),
+    'dim7': (0, 3, 6, 9), 'm7b5': (0, 3, 6, 10), 'm7-5': (0, 3, 6, 10), '7b5': (0, 4, 6, 10),
+    '7-5': (0, 4, 6, 10), '7+5': (0, 4, 8, 10), '7sus4': (0, 5, 7, 10), 'add9': (0, 4, 7, 14),
+    'madd9': (0, 3, 7, 14), '9': (0, 4, 7, 10, 14), 'maj9': (0, 4, 7, 11, 14), 'm9': (0, 3, 7, 10, 14),
+    '7b9': (0, 4, 7, 10, 13), '7#9': (0, 4, 7, 10, 15), '11': (0, 4, 7, 10, 14, 17),
+    '13': (0, 4, 7, 10, 14, 17, 21),
+}
+MAX_NOTES = 8
+
+# Voicings: 'fixed' puts every note in the octave starting at CHORD_LOW (how the program has always voiced
+# chords), 'close' stacks the notes upwards from the lowest one
+CHORD_LOW = 60
+
+
+def note_pitch_class(name):
+    # Any spelling, including E#, B#, Cb, Fb and double accidentals
+    try:
+        return (NOTE_LETTERS[name[0]] + ACCIDENTALS[name[1:]]) % 12
+    except (KeyError, IndexError):
+        raise ValueError(f"Unknown note: {name}") from None
+
+
+def _pychord_semitones(name):
+    try:
+        return Chord(name).components(visible=False)
+    except Exception as e:
+        raise ValueError(f"Unknown chord: {name}") from e
+
+
+class ChordTable:
+    # Every root spelling x every quality in QUALITIES, precomputed into read-only arrays:
+    #   semitones[row, :sizes[row]]  chord notes as semitones above C, bass (slash) note first
+    # Anything else (slash chords, rarer qualities) is parsed once with pychord and remembered.
+
+    def __init__(self):
+        names = []
+        rows = []
+        for letter, base in NOTE_LETTERS.items():
+            for accidental, shift in ACCIDENTALS.items():
+                root = (base + shift) % 12
+                for quality, intervals in QUALITIES.items():
+                    names.append(letter + accidental + quality)
+                    rows.append([root + interval for interval in intervals])
+        self.names = tuple(names)
+        self.index = {name: row for row, name in enumerate(names)}
+        self.semitones = np.zeros((len(rows), MAX_NOTES), dtype=np.int16)
+        self.sizes = np.array([len(row) for row in rows], dtype=np.int16)
+        for i, row in enumerate(rows):
+            self.semitones[i, :len(row)] = row
+        self.semitones.setflags(write=False)
+        self.sizes.setflags(write=False)
+        self._extra = {}
+        self._extra_lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.index or name in self._extra
+
+    def row(self, name):
+        if name in self.index:
+            row = self.index[name]
+            return self.semitones[row], self.sizes[row]
+        extra = self._extra.get(name)
+        if extra is None:
+            semitones = _pychord_semitones(name)[:MAX_NOTES]
+            extra = np.zeros(MAX_NOTES, dtype=np.int16), np.int16(len(semitones))
+            extra[0][:len(semitones)] = semitones
+            extra[0].setflags(write=False)
+            with self._extra_lock:
+                extra = self._extra.setdefault(name, extra)
+        return extra
+
+    def lookup(self, chords):
+        # -> (semitones (n, MAX_NOTES), sizes (n,)) for a whole progression
+        ids = [self.index.get(name, -1) for name in chords]
+        if -1 not in ids:
+            return self.semitones[ids], self.sizes[ids]
+        rows = [self.row(name) for name in chords]
+        return np.array([semitones for semitones, _ in rows]), np.array([size for _, size in rows])
+
+    def resolve(self, chords, voicing='fixed', low=CHORD_LOW):
+        # Chord names -> (pitches, sizes, bass): MIDI pitches (n, MAX_NOTES) padded with -1,
+        # notes per chord, and the bass note an octave below low
+        semitones, sizes = self.lookup(chords)
+        present = np.arange(MAX_NOTES) < sizes[:, None]
+        if voicing == 'fixed':
+            pitches = low + semitones % 12
+        elif voicing == 'close':
+            first = semitones[:, :1]
+            pitches = low + semitones - (first - first % 12)
+        else:
+            raise ValueError(f"Unknown voicing: {voicing}")
+        bass = low - 12 + semitones[:, 0] % 12
+        return np.where(present, pitches, -1), sizes, bass
+
+
+@lru_cache(maxsize=None)
+def get_chord_table():
+    return ChordTable()
+
+
+def resolve_progression(chords, voicing='fixed', low=CHORD_LOW):
+    return get_chord_table().resolve(chords, voicing, low)
+
+
+def progression_to_midi(chords, voicing='fixed', low=CHORD_LOW):
+    # -> (chord_notes, bass_notes): MIDI pitches per chord and one bass pitch per chord, as lists
+    pitches, sizes, bass = resolve_progression(chords, voicing, low)
+    return [row[:size] for row, size in zip(pitches.tolist(), sizes.tolist())], bass.tolist()
@@ -0,0 +1,141 @@
+import argparse
+import os
+
+
+def add_batch_parser(subparsers):
+    parser = subparsers.add_parser('batch', help="render every job of a manifest in parallel")
+    parser.add_argument('manifest', help="jobs as .json, .jsonl or .csv (mood, start_chord, tempo, repetitions, synth, drums, bass, lead)")
+    parser.add_argument('-o', '--output-dir', default='output')
+    parser.add_argument('-f', '--formats', default='mid,mp3', help="comma-separated subset of mid,mp3,wav,ogg,flac")
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help="render processes")
+    parser.add_argument('--seed', type=int, default=None, help="seed for chord generation")
+    parser.add_argument('--stems', action='store_true', help="also write chords, bass, lead and drums stems in every audio format")
+    parser.add_argument('--bitrate', default=None, help="MP3/OGG bitrate, e.g. 192k (default: the encoder's)")
+
+
+def run_batch_command(args):
+    from .batch import run_batch
+
+    formats = [fmt.strip().lower() for fmt in args.formats.split(',') if fmt.strip()]
+    results = run_batch(args.manifest, args.output_dir, formats, args.workers, args.seed, stems=args.stems,
+                        bitrate=args.bitrate)
+    failed = [result for result in results if 'error' in result]
+    print(f"Rendered {len(results) - len(failed)} of {len(results)} jobs into {args.output_dir}")
+    return 1 if failed else 0
+
+
+def add_serve_parser(subparsers):
+    parser = subparsers.add_parser('serve', help="run the local HTTP generation and rendering service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--render-concurrency', type=int, default=2, help="renders running at once")
+    parser.add_argument('--max-waiting-renders', type=int, default=16, help="queued renders before answering 503")
+    parser.add_argument('--batch-window-ms', type=float, default=5, help="how long to collect generation requests")
+    parser.add_argument('--max-batch', type=int, default=512, help="progressions per forward pass")
+    parser.add_argument('--max-pending', type=int, default=1024, help="queued generation requests before answering 503")
+
+
+def run_serve_command(args):
+    from .service import run_service
+
+    run_service(args.host, args.port, render_concurrency=args.render_concurrency,
+                max_waiting_renders=args.max_waiting_renders, window_ms=args.batch_window_ms,
+                max_batch=args.max_batch, max_pending=args.max_pending)
+    return 0
+
+
+def add_train_parser(subparsers):
+    parser = subparsers.add_parser('train', help="train the chord models from their progression corpora")
+    parser.add_argument('moods', nargs='*', help="moods to train (default: every <mood>_chord_progressions.txt)")
+    parser.add_argument('--corpus-dir', default=None, help="where the corpora are (default: ai_models_generation)")
+    parser.add_argument('-o', '--output-dir', default=None, help="where the models are written (default: the program folder)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="moods trained at once")
+    parser.add_argument('--fine-tune', action='store_true',
+                        help="continue training the existing models on the progressions added since their last training")
+    parser.add_argument('--data', default=None, help="with --fine-tune and one mood: train on this file of new progressions instead")
+    parser.add_argument('--epochs', type=int, default=None, help="default: 80, or 10 when fine-tuning")
+    parser.add_argument('--batch-size', type=int, default=None, help="default: 32")
+    parser.add_argument('--patience', type=int, default=None, help="epochs without improvement before stopping")
+    parser.add_argument('--learning-rate', type=float, default=None)
+    parser.add_argument('--checkpoint-dir', default=None, help="resume state of interrupted runs (default: <output>/checkpoints)")
+    parser.add_argument('--cache', default=None, help="cache file prefix for the training windows (default: in memory)")
+
+
+def run_train_command(args):
+    from .paths import DATA_DIR
+    from .training import CORPUS_DIR, train_moods
+
+    options = {name: getattr(args, name) for name in ('epochs', 'batch_size', 'patience', 'learning_rate', 'cache')
+               if getattr(args, name) is not None}
+    if args.data:
+        if not args.fine_tune or len(args.moods) != 1:
+            print("--data needs --fine-tune and exactly one mood")
+            return 2
+        options['data_file'] = args.data
+    results = train_moods(args.moods, args.corpus_dir or CORPUS_DIR, args.output_dir or DATA_DIR, args.jobs,
+                          fine_tune=args.fine_tune, checkpoint_dir=args.checkpoint_dir, **options)
+    for result in results:
+        if not result['epochs']:
+            print(f"{result['mood']}: no new progressions")
+            continue
+        print(f"{result['mood']}: {result['chords']} chords, {result['epochs']} epochs, loss {result['loss']} -> {result['model']}")
+    return 0
+
+
+def add_bench_parser(subparsers):
+    parser = subparsers.add_parser('bench', help="time every stage of the generate -> MIDI -> audio pipeline")
+    parser.add_argument('--mood', default='happy')
+    parser.add_argument('--tempos', default='90,120,160')
+    parser.add_argument('--repetitions', default='1,4,16')
+    parser.add_argument('--drums', default='all', help="comma-separated drum styles, 'No' included, or all")
+    parser.add_argument('--flags', default='none,bass,lead,both', help="comma-separated subset of none,bass,lead,both")
+    parser.add_argument('--runs', type=int, default=5, help="tracks rendered per combination")
+    parser.add_argument('-f', '--format', default='mp3', help="export format (mp3, wav, ogg or flac)")
+    parser.add_argument('--synth', default='Piano', help="SoundFont name or .sf2 path")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='bench_results.json', help="where to save the results as JSON")
+    parser.add_argument('--compare', default=None, help="an earlier results file to compare against")
+
+
+def run_bench_command(args):
+    from .bench import compare_results, load_results, run_benchmark, save_results
+
+    def split(value):
+        return [item.strip() for item in value.split(',') if item.strip()]
+
+    results = run_benchmark(mood=args.mood, tempos=[int(t) for t in split(args.tempos)],
+                            repetitions=[int(r) for r in split(args.repetitions)],
+                            drum_styles=None if args.drums == 'all' else split(args.drums), flags=split(args.flags),
+                            runs=args.runs, fmt=args.format.lower(), synth=args.synth, seed=args.seed)
+    save_results(results, args.output)
+    for stage, summary in results['stages'].items():
+        fmt = f" ({summary['format']})" if 'format' in summary else ''
+        print(f"{stage:>15}: p50 {summary['p50_ms']:.3f} ms  p90 {summary['p90_ms']:.3f} ms  p99 {summary['p99_ms']:.3f} ms{fmt}")
+    for stage, reason in results['skipped'].items():
+        print(f"{stage:>15}: skipped, {reason}")
+    throughput = results['throughput']
+    print(f"{throughput['tracks']} tracks in {throughput['wall_seconds']} s ({throughput['tracks_per_second']} tracks/s, "
+          f"{throughput['audio_seconds_per_second']}x real time), peak RSS {results['peak_rss_mb']} MB")
+    if args.compare:
+        print(f"Compared with {args.compare}:")
+        for line in compare_results(load_results(args.compare), results):
+            print(line)
+    print(f"Saved to {args.output}")
+    return 0
+
+
+COMMANDS = {
+    'batch': (add_batch_parser, run_batch_command),
+    'serve': (add_serve_parser, run_serve_command),
+    'train': (add_train_parser, run_train_command),
+    'bench': (add_bench_parser, run_bench_command),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='makethemusic', description="Headless MakeTheMusic tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for add_parser, _ in COMMANDS.values():
+        add_parser(subparsers)
+    args = parser.parse_args(argv)
+    return COMMANDS[args.command][1](args)
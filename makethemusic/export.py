@@ -0,0 +1,137 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .chord_table import progression_to_midi
+from .drum_mixer import mix_drums
+from .midi_builder import midi_bytes, write_midi
+from .pipeline import note_pattern, timed_stage
+from .streaming import open_stream_writer
+from .synth_backend import CHANNELS, SAMPLE_RATE, render_midi_to_pcm
+
+# One render, every deliverable: the note pattern and MIDI are built once per track, synthesised once
+# (once per part when stems are wanted), and the resulting PCM buffers are encoded into all requested
+# formats at the same time, each encoder on its own pool thread.
+AUDIO_FORMATS = ('mp3', 'wav', 'ogg', 'flac')
+MIDI_FORMAT = 'mid'
+# Stems by note_pattern track number; drums are mixed in from samples rather than synthesised
+NOTE_STEMS = ('chords', 'bass', 'lead')
+STEMS = NOTE_STEMS + ('drums',)
+MIX = 'mix'
+
+
+def build_arrangement(chords, tempo, repetitions, add_bass=False, add_lead=False, instrument=None):
+    # Everything a track's exports share: the note pattern of one repetition and the full MIDI file.
+    # instrument(stage, seconds) receives the time of 'resolve_chords' and 'midi'.
+    with timed_stage(instrument, 'resolve_chords'):
+        chord_notes, bass_notes = progression_to_midi(chords)
+    with timed_stage(instrument, 'midi'):
+        pattern = note_pattern(chord_notes, bass_notes, tempo, add_bass, add_lead)
+        num_tracks = 3 if add_lead else (2 if add_bass else 1)
+        block_beats = len(chord_notes) * 4
+        midi = midi_bytes(pattern, repetitions, block_beats, tempo, num_tracks)
+    return {
+        'pattern': pattern,
+        'tempo': tempo,
+        'repetitions': repetitions,
+        'block_beats': block_beats,
+        'parts': [stem for track, stem in enumerate(NOTE_STEMS) if (pattern['track'] == track).any()],
+        'midi': midi,
+    }
+
+
+def stem_midi(arrangement, stem):
+    # A single-track MIDI file holding just one part of the arrangement
+    pattern = arrangement['pattern']
+    part = pattern[pattern['track'] == NOTE_STEMS.index(stem)].copy()
+    part['track'] = 0
+    return midi_bytes(part, arrangement['repetitions'], arrangement['block_beats'], arrangement['tempo'], 1)
+
+
+def _pad(samples, frames):
+    if len(samples) >= frames:
+        return samples
+    return np.concatenate([samples, np.zeros((frames - len(samples), samples.shape[1]), dtype=samples.dtype)])
+
+
+def render_arrangement(arrangement, soundfont, drum_style="No", drum_volume=0.5, stems=False, instrument=None):
+    # -> {'mix': int16 (frames, 2), and with stems=True one buffer per part played ('chords', 'bass',
+    # 'lead', 'drums')}. With stems each part is synthesised on its own and the mix is their sum,
+    # so the stems add up to the mix (to within rounding, wherever it doesn't clip).
+    # instrument(stage, seconds) receives the time of 'synth' and 'drums'.
+    tempo = arrangement['tempo']
+    if not stems:
+        with timed_stage(instrument, 'synth'):
+            samples = render_midi_to_pcm(arrangement['midi'], soundfont)
+        with timed_stage(instrument, 'drums'):
+            return {MIX: mix_drums(samples, drum_style, tempo, drum_volume)}
+
+    buffers = {}
+    with timed_stage(instrument, 'synth'):
+        for stem in arrangement['parts']:
+            buffers[stem] = render_midi_to_pcm(stem_midi(arrangement, stem), soundfont)
+    frames = max((len(samples) for samples in buffers.values()), default=0)
+    buffers = {stem: _pad(samples, frames) for stem, samples in buffers.items()}
+    notes = np.zeros((frames, CHANNELS), dtype=np.float32)
+    for samples in buffers.values():
+        notes += samples
+    notes = np.clip(notes, -32768, 32767).astype(np.int16)
+    with timed_stage(instrument, 'drums'):
+        if drum_style != "No":
+            buffers['drums'] = mix_drums(np.zeros_like(notes), drum_style, tempo, drum_volume)
+        buffers[MIX] = mix_drums(notes, drum_style, tempo, drum_volume)
+    return buffers
+
+
+def export_targets(base, formats, stems=()):
+    # -> {(buffer name, format): path}: <base>.<fmt> for the mix and <base>_<stem>.<fmt> for each stem
+    targets = {}
+    for fmt in formats:
+        if fmt not in AUDIO_FORMATS:
+            continue
+        targets[MIX, fmt] = f'{base}.{fmt}'
+        for stem in stems:
+            targets[stem, fmt] = f'{base}_{stem}.{fmt}'
+    return targets
+
+
+def write_audio(samples, path, fmt=None, sample_rate=SAMPLE_RATE, bitrate=None):
+    # Through the same writers as the streaming renderer: WAV directly, everything else piped into ffmpeg.
+    # bitrate applies to MP3 and OGG; without one ffmpeg's default is used (128k for MP3).
+    writer = open_stream_writer(path, fmt, sample_rate, samples.shape[1], bitrate)
+    try:
+        for start in range(0, len(samples), sample_rate):
+            writer.write(samples[start:start + sample_rate])
+    finally:
+        writer.close()
+    return path
+
+
+def export_buffers(buffers, targets, sample_rate=SAMPLE_RATE, bitrate=None, workers=None, instrument=None):
+    # Writes every target concurrently. The encoders are ffmpeg processes and WAV is plain file I/O, so
+    # threads are enough to keep them all busy. -> the paths written, in target order
+    if not targets:
+        return []
+    with timed_stage(instrument, 'export'):
+        with ThreadPoolExecutor(max_workers=workers or min(len(targets), (os.cpu_count() or 1) + 2)) as pool:
+            futures = [pool.submit(write_audio, buffers[name], path, fmt, sample_rate, bitrate)
+                       for (name, fmt), path in targets.items()]
+            return [future.result() for future in futures]
+
+
+def export_track(chords, soundfont, base, formats, tempo=120, repetitions=1, drum_style="No", add_bass=False,
+                 add_lead=False, drum_volume=0.5, stems=False, bitrate=None, workers=None,
+                 instrument=None):
+    # Renders a track once and writes <base>.mid plus every audio format, and the stems of every
+    # format with stems=True. -> the paths written
+    arrangement = build_arrangement(chords, tempo, repetitions, add_bass, add_lead, instrument)
+    files = []
+    if MIDI_FORMAT in formats:
+        files.append(f'{base}.mid')
+        write_midi(arrangement['midi'], files[-1])
+    if not any(fmt in AUDIO_FORMATS for fmt in formats):
+        return files
+    buffers = render_arrangement(arrangement, soundfont, drum_style, drum_volume, stems, instrument)
+    targets = export_targets(base, formats, [stem for stem in STEMS if stem in buffers])
+    return files + export_buffers(buffers, targets, bitrate=bitrate, workers=workers, instrument=instrument)
@@ -0,0 +1,87 @@
+import os
+import struct
+
+import numpy as np
+
+TICKS_PER_BEAT = 960
+
+# One row per note of a single repetition; start and duration are in beats
+NOTE_DTYPE = np.dtype([('track', 'u1'), ('pitch', 'u1'), ('start', 'f8'), ('duration', 'f8'), ('velocity', 'u1')])
+
+
+def make_pattern(notes):
+    # notes: (track, pitch, start, duration, velocity) tuples in the order they were added
+    return np.array(list(notes), dtype=NOTE_DTYPE)
+
+
+def varlen(value):
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(out)
+
+
+def pattern_events(pattern, channel=0):
+    # Note-on/off rows of one repetition, ordered the way midiutil orders them: by tick, note-offs
+    # before note-ons on the same tick, then by the order the notes were added.
+    # Returns (ticks, statuses, pitches, velocities) as arrays.
+    n = len(pattern)
+    starts = np.rint(pattern['start'] * TICKS_PER_BEAT).astype(np.int64)
+    ends = starts + np.rint(pattern['duration'] * TICKS_PER_BEAT).astype(np.int64)
+    ticks = np.concatenate([starts, ends])
+    note_on = np.repeat([True, False], n)
+    order = np.lexsort((np.tile(np.arange(n), 2), note_on, ticks))
+    statuses = np.where(note_on, 0x90 | channel, 0x80 | channel)
+    return (ticks[order], statuses[order], np.tile(pattern['pitch'], 2)[order],
+            np.tile(pattern['velocity'], 2)[order])
+
+
+def track_chunk(data):
+    return b'MTrk' + struct.pack('>I', len(data)) + data
+
+
+def note_track(pattern, repeats, block_beats, channel=0):
+    # The first repetition is encoded once; every later one is the same bytes except for the delta
+    # into its first event, so the track is built by repeating a byte string rather than per note.
+    # Relies on every note ending by the end of its block, which holds for chord-aligned patterns.
+    end_of_track = b'\x00\xff\x2f\x00'
+    if not len(pattern) or repeats <= 0:
+        return track_chunk(end_of_track)
+    ticks, statuses, pitches, velocities = pattern_events(pattern, channel)
+    block_ticks = int(round(block_beats * TICKS_PER_BEAT))
+    if ticks[-1] > block_ticks:
+        raise ValueError("Notes must end within their block")
+
+    parts = []
+    for i, (tick, status, pitch, velocity) in enumerate(zip(ticks.tolist(), statuses.tolist(), pitches.tolist(),
+                                                            velocities.tolist())):
+        if i:
+            parts.append(varlen(tick - previous))
+        parts.append(bytes((status, pitch, velocity)))
+        previous = tick
+    body = b''.join(parts)
+    first_tick = int(ticks[0])
+    repeat = varlen(block_ticks - int(ticks[-1]) + first_tick) + body
+    return track_chunk(varlen(first_tick) + body + repeat * (repeats - 1) + end_of_track)
+
+
+def midi_bytes(pattern, repeats, block_beats, tempo, num_tracks):
+    # A format 1 file laid out like midiutil writes it: a tempo track followed by num_tracks note tracks
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, num_tracks + 1, TICKS_PER_BEAT)
+    tempo_track = track_chunk(b'\x00\xff\x51\x03' + struct.pack('>I', int(60000000 / tempo))[1:] + b'\x00\xff\x2f\x00')
+    tracks = [note_track(pattern[pattern['track'] == track], repeats, block_beats) for track in range(num_tracks)]
+    return header + tempo_track + b''.join(tracks)
+
+
+def write_midi(data, output=None):
+    # output: a path, a writable binary file, or None to get the bytes back
+    if output is None:
+        return data
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, 'wb') as f:
+            f.write(data)
+    else:
+        output.write(data)
+    return data
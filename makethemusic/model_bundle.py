@@ -0,0 +1,114 @@
+import json
+import os
+import pickle
+import struct
+import sys
+
+import numpy as np
+
+from .numpy_model import model_arrays, model_from_arrays
+from .transition_table import CONTEXT_LENGTH
+
+# A mood model in one file, loaded without h5py, TensorFlow or pickle:
+#   magic (8 bytes) | header length (little-endian uint64) | UTF-8 JSON header | raw weight arrays
+# The header holds the vocabulary (chord names in id order), metadata, and for every array its dtype,
+# shape and offset from the start of the data section, which begins at the first 64-byte boundary after
+# the header. Arrays are 64-byte aligned and memory-mapped read-only, so every process that loads the same
+# bundle shares its pages through the OS page cache.
+BUNDLE_EXTENSION = '.mtm'
+BUNDLE_MAGIC = b'MTMODEL\0'
+BUNDLE_VERSION = 1
+ALIGNMENT = 64
+
+
+def _align(n):
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def write_bundle(path, arrays, vocabulary, metadata=None):
+    arrays = {name: np.asarray(value, dtype=np.asarray(value).dtype.newbyteorder('<'), order='C')
+              for name, value in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, value in arrays.items():
+        layout[name] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+        offset = _align(offset + value.nbytes)
+    header = json.dumps({
+        'version': BUNDLE_VERSION,
+        'vocabulary': list(vocabulary),
+        'metadata': metadata or {},
+        'arrays': layout,
+    }).encode('utf-8')
+    data_start = _align(len(BUNDLE_MAGIC) + 8 + len(header))
+
+    part = f'{path}.part'
+    with open(part, 'wb') as f:
+        f.write(BUNDLE_MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, value in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(value.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(part, path)
+
+
+def read_bundle_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not a model bundle")
+        (length,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header.get('version', 0) > BUNDLE_VERSION:
+        raise ValueError(f"{path} needs a newer version of the program (bundle version {header['version']})")
+    header['data_start'] = _align(len(BUNDLE_MAGIC) + 8 + length)
+    return header
+
+
+def read_bundle(path):
+    # -> (header, {name: read-only array backed by the file mapping})
+    header = read_bundle_header(path)
+    mapping = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        arrays[name] = np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=mapping,
+                                  offset=header['data_start'] + spec['offset'])
+    return header, arrays
+
+
+def load_bundle(path):
+    # -> (model, chord_to_int, int_to_chord), the same triple as model_registry.load_model_and_dictionaries
+    header, arrays = read_bundle(path)
+    model = model_from_arrays(arrays)
+    vocabulary = header['vocabulary']
+    if len(vocabulary) != model.num_chords:
+        raise ValueError(f"{path} has {len(vocabulary)} chords but the model predicts {model.num_chords}")
+    chord_to_int = {chord: i for i, chord in enumerate(vocabulary)}
+    int_to_chord = dict(enumerate(vocabulary))
+    return model, chord_to_int, int_to_chord
+
+
+def convert_model(model_name, bundle_file=None):
+    # <model_name>.npz (or .h5) + both pickles -> <model_name>.mtm
+    if os.path.exists(f'{model_name}.npz'):
+        with np.load(f'{model_name}.npz') as data:
+            arrays = {name: data[name] for name in data.files}
+        source = f'{os.path.basename(model_name)}.npz'
+    else:
+        import tensorflow as tf
+        arrays = model_arrays(tf.keras.models.load_model(f'{model_name}.h5'))
+        source = f'{os.path.basename(model_name)}.h5'
+    with open(f'{model_name}_int_to_chord.pkl', 'rb') as f:
+        int_to_chord = pickle.load(f)
+    vocabulary = [int_to_chord[i] for i in range(len(int_to_chord))]
+
+    bundle_file = bundle_file or f'{model_name}{BUNDLE_EXTENSION}'
+    write_bundle(bundle_file, arrays, vocabulary, {'source': source, 'context_length': CONTEXT_LENGTH})
+    return bundle_file
+
+
+if __name__ == '__main__':
+    # python -m makethemusic.model_bundle happy_model sad_model
+    from .paths import data_path
+
+    for name in sys.argv[1:] or ['happy_model', 'sad_model']:
+        bundle_file = convert_model(data_path(name))
+        print(f"Converted {name} -> {os.path.basename(bundle_file)}")
@@ -0,0 +1,156 @@
+import os
+import pickle
+import threading
+
+from .model_bundle import BUNDLE_EXTENSION, load_bundle
+from .numpy_model import load_npz_model
+from .paths import DATA_DIR
+from .transition_table import build_transition_table, load_transition_table, save_transition_table
+
+MODEL_SUFFIX = '_model'
+MODEL_EXTENSIONS = (BUNDLE_EXTENSION, '.npz', '.h5')
+
+_models = {}
+_tables = {}
+_load_locks = {}
+_registry_lock = threading.Lock()
+_model_dirs = {}
+
+
+def load_model_and_dictionaries(model_name):
+    # A .mtm bundle carries its own vocabulary and is memory-mapped; otherwise the exported NumPy weights
+    # are preferred so TensorFlow is only imported for .h5-only models
+    if os.path.exists(f'{model_name}{BUNDLE_EXTENSION}'):
+        return load_bundle(f'{model_name}{BUNDLE_EXTENSION}')
+    if os.path.exists(f'{model_name}.npz'):
+        model = load_npz_model(f'{model_name}.npz')
+    else:
+        import tensorflow as tf
+        model = tf.keras.models.load_model(f'{model_name}.h5')
+
+    with open(f'{model_name}_chord_to_int.pkl', 'rb') as f:
+        chord_to_int = pickle.load(f)
+    with open(f'{model_name}_int_to_chord.pkl', 'rb') as f:
+        int_to_chord = pickle.load(f)
+
+    return model, chord_to_int, int_to_chord
+
+
+def discover_moods(model_dir=DATA_DIR):
+    # A mood is available when <mood>_model.mtm exists, or <mood>_model.npz or .h5 and both of its pickles
+    moods = []
+    for filename in sorted(os.listdir(model_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext not in MODEL_EXTENSIONS or not name.endswith(MODEL_SUFFIX):
+            continue
+        mood = name[:-len(MODEL_SUFFIX)]
+        base = os.path.join(model_dir, name)
+        if mood in moods:
+            continue
+        if ext == BUNDLE_EXTENSION or (os.path.exists(f'{base}_chord_to_int.pkl') and
+                                       os.path.exists(f'{base}_int_to_chord.pkl')):
+            moods.append(mood)
+    return moods
+
+
+def register_model_dir(model_dir=DATA_DIR):
+    moods = discover_moods(model_dir)
+    with _registry_lock:
+        for mood in moods:
+            _model_dirs[mood] = model_dir
+    return moods
+
+
+def available_moods():
+    with _registry_lock:
+        return sorted(_model_dirs)
+
+
+def model_path(mood):
+    # <model dir>/<mood>_model, without extension
+    if not mood or os.path.basename(mood) != mood or mood in ('.', '..'):
+        raise ValueError(f"Invalid mood: {mood}")
+    with _registry_lock:
+        model_dir = _model_dirs.get(mood, DATA_DIR)
+    return os.path.join(model_dir, f'{mood}{MODEL_SUFFIX}')
+
+
+def _lock_for(key):
+    with _registry_lock:
+        if key not in _load_locks:
+            _load_locks[key] = threading.Lock()
+        return _load_locks[key]
+
+
+def get_model(mood):
+    # Returns (model, chord_to_int, int_to_chord), loading from disk only once per mood
+    entry = _models.get(mood)
+    if entry is not None:
+        return entry
+
+    with _lock_for(mood):
+        entry = _models.get(mood)
+        if entry is None:
+            entry = load_model_and_dictionaries(model_path(mood))
+            _models[mood] = entry
+    return entry
+
+
+def get_transition_table(mood):
+    # Loads <mood>_model_table.npz when it was prebuilt, otherwise builds the table from the model once and
+    # saves it there for the next start (training deletes it whenever the model changes)
+    table = _tables.get(mood)
+    if table is not None:
+        return table
+
+    with _lock_for((mood, 'table')):
+        table = _tables.get(mood)
+        if table is None:
+            model, chord_to_int, _ = get_model(mood)
+            table_file = f'{model_path(mood)}_table.npz'
+            try:
+                table = load_transition_table(table_file, model, len(chord_to_int))
+            except (OSError, ValueError):
+                # Not prebuilt, or prebuilt for an older vocabulary
+                table = build_transition_table(model, len(chord_to_int))
+                try:
+                    save_transition_table(table, table_file)
+                except OSError:
+                    pass
+            _tables[mood] = table
+    return table
+
+
+def is_loaded(mood):
+    return mood in _models
+
+
+def unload_model(mood=None):
+    with _registry_lock:
+        if mood is None:
+            _models.clear()
+            _tables.clear()
+        else:
+            _models.pop(mood, None)
+            _tables.pop(mood, None)
+
+
+def warm_models(moods=None, background=True, tables=False):
+    if moods is None:
+        moods = available_moods()
+
+    def warm():
+        for mood in moods:
+            try:
+                get_model(mood)
+                if tables:
+                    get_transition_table(mood)
+            except (OSError, ValueError) as e:
+                print(f"Could not load the {mood} model: {e}")
+
+    if not background:
+        warm()
+        return None
+    thread = threading.Thread(target=warm, name='model-warmup', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,119 @@
+import sys
+
+import numpy as np
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def lstm_step(x, h, c, kernel, recurrent_kernel, bias):
+    # One Keras LSTM cell update, gates packed in Keras order: input, forget, cell, output
+    z = x @ kernel + h @ recurrent_kernel + bias
+    i, f, g, o = np.split(z, 4, axis=-1)
+    c = _sigmoid(f) * c + _sigmoid(i) * np.tanh(g)
+    h = _sigmoid(o) * np.tanh(c)
+    return h, c
+
+
+class NumpyChordModel:
+    # Inference-only mirror of create_model() in ai_models_generation: Embedding -> LSTM -> Dropout -> LSTM -> Dense.
+    # predict() takes the same (batch, 3) int input as the Keras model and returns softmax rows.
+
+    def __init__(self, embeddings, lstm_layers, dense_kernel, dense_bias):
+        self.embeddings = embeddings
+        self.lstm_layers = lstm_layers
+        self.dense_kernel = dense_kernel
+        self.dense_bias = dense_bias
+
+    @property
+    def units(self):
+        return [recurrent_kernel.shape[0] for _, recurrent_kernel, _ in self.lstm_layers]
+
+    @property
+    def num_chords(self):
+        return self.dense_bias.shape[0]
+
+    def initial_state(self, batch_size):
+        dtype = self.embeddings.dtype
+        return [(np.zeros((batch_size, units), dtype=dtype), np.zeros((batch_size, units), dtype=dtype)) for units in self.units]
+
+    def step(self, ids, state):
+        # Advances every LSTM layer by one chord and returns (softmax, new_state)
+        x = self.embeddings[np.asarray(ids, dtype=np.int64)]
+        new_state = []
+        for (kernel, recurrent_kernel, bias), (h, c) in zip(self.lstm_layers, state):
+            h, c = lstm_step(x, h, c, kernel, recurrent_kernel, bias)
+            new_state.append((h, c))
+            x = h
+        return _softmax(x @ self.dense_kernel + self.dense_bias), new_state
+
+    def predict(self, x, verbose=0):
+        x = np.asarray(x, dtype=np.int64)
+        state = self.initial_state(x.shape[0])
+        for t in range(x.shape[1]):
+            prediction, state = self.step(x[:, t], state)
+        return prediction
+
+    def __call__(self, x):
+        return self.predict(x)
+
+
+def model_from_arrays(arrays):
+    # arrays: any mapping with the names export_npz writes (an open .npz, a dict of memmapped views, ...)
+    num_lstm = int(arrays['num_lstm'])
+    lstm_layers = [
+        (arrays[f'lstm_{n}_kernel'], arrays[f'lstm_{n}_recurrent_kernel'], arrays[f'lstm_{n}_bias'])
+        for n in range(num_lstm)
+    ]
+    return NumpyChordModel(arrays['embeddings'], lstm_layers, arrays['dense_kernel'], arrays['dense_bias'])
+
+
+def load_npz_model(npz_file):
+    with np.load(npz_file) as data:
+        return model_from_arrays(data)
+
+
+def model_arrays(keras_model):
+    arrays = {}
+    num_lstm = 0
+    for layer in keras_model.layers:
+        kind = layer.__class__.__name__
+        weights = [np.asarray(w, dtype=np.float32) for w in layer.get_weights()]
+        if kind == 'Embedding':
+            arrays['embeddings'] = weights[0]
+        elif kind == 'LSTM':
+            arrays[f'lstm_{num_lstm}_kernel'], arrays[f'lstm_{num_lstm}_recurrent_kernel'], arrays[f'lstm_{num_lstm}_bias'] = weights
+            num_lstm += 1
+        elif kind == 'Dense':
+            arrays['dense_kernel'], arrays['dense_bias'] = weights
+        elif weights:
+            raise ValueError(f"Cannot export layer {layer.name} of type {kind}")
+    arrays['num_lstm'] = np.array(num_lstm)
+    return arrays
+
+
+def export_npz(keras_model, npz_file):
+    np.savez(npz_file, **model_arrays(keras_model))
+
+
+def export_h5_to_npz(model_name):
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(f'{model_name}.h5')
+    export_npz(model, f'{model_name}.npz')
+    return model
+
+
+if __name__ == '__main__':
+    # python -m makethemusic.numpy_model happy_model sad_model
+    from .paths import data_path
+
+    for name in sys.argv[1:] or ['happy_model', 'sad_model']:
+        export_h5_to_npz(data_path(name))
+        print(f"Exported {name}.h5 -> {name}.npz")
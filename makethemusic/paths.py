@@ -0,0 +1,8 @@
+import os
+
+# Models, sounds and text files live next to the package, in the repository root
+DATA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def data_path(path):
+    return path if os.path.isabs(path) else os.path.join(DATA_DIR, path)
@@ -0,0 +1,138 @@
+import time
+from contextlib import contextmanager
+
+from pychord import Chord
+
+from .chord_table import CHORD_LOW, note_pitch_class, progression_to_midi
+from .midi_builder import TICKS_PER_BEAT, make_pattern, midi_bytes, pattern_events, write_midi
+from .paths import data_path
+
+SOUNDFONTS = {
+    'Piano': 'sounds/GeneralUser_GS_v1.471.sf2',
+    'Marimba': 'sounds/marimba-deadstroke.sf2',
+    'Old video games': 'sounds/PICO-8_1.1.2.sf2',
+}
+
+def chords_to_notes(chord_progression):
+    # Note names per chord as pychord spells them; the renderers resolve chords through the chord table instead
+    return [Chord(chord).components() for chord in chord_progression]
+
+def notes_to_midi_with_bass(chord_notes):
+    # Note names in any spelling (E#, B#, Bbb, ...) -> pitches in the octave from middle C, bass an octave lower
+    midi_chords = []
+    bass_notes = []
+    for chord in chord_notes:
+        midi_chord = [CHORD_LOW + note_pitch_class(note) for note in chord]
+        midi_chords.append(midi_chord)
+        bass_notes.append(midi_chord[0] - 12)
+    return midi_chords, bass_notes
+
+def generate_lead_melody(chords_notes, tempo, repetitions):
+    if not chords_notes:
+        return []
+
+    lead_notes = []
+    time_offset = 0  
+
+    for _ in range(repetitions):  
+        for chord in chords_notes:
+            if len(chord) < 3:
+                continue 
+
+            midi_notes = sorted(chord)  
+            midi_notes = [note + 12 for note in midi_notes]  
+
+            rhythm_pattern = [1, 1, 2]
+
+            note_time = time_offset 
+            for note, duration in zip(midi_notes, rhythm_pattern):
+                lead_notes.append((note, note_time, duration))
+                note_time += duration  
+
+            time_offset += 4  
+
+    return lead_notes
+
+def note_pattern(chord_notes, bass_notes, tempo, add_bass, add_lead):
+    # One repetition of the arrangement (4 beats per chord) as a midi_builder note array:
+    # track 0 chords, track 1 bass, track 2 lead
+    volume = 100
+    lead_volume = 110
+    notes = [(0, pitch, i * 4, 4, volume) for i, chord in enumerate(chord_notes) for pitch in chord]
+    if add_bass:
+        notes += [(1, bass, i * 4, 4, volume) for i, bass in enumerate(bass_notes)]
+    if add_lead:
+        for i, chord in enumerate(chord_notes):
+            notes += [(2, pitch, i * 4 + t, duration, lead_volume)
+                      for pitch, t, duration in generate_lead_melody([chord], tempo, 1)]
+    return make_pattern(notes)
+
+def progression_midi(chord_notes, bass_notes, output_file, repeats, tempo, add_bass, add_lead):
+    # output_file may be a path, a binary file object, or None; the MIDI bytes are returned either way
+    pattern = note_pattern(chord_notes, bass_notes, tempo, add_bass, add_lead)
+    num_tracks = 3 if add_lead else (2 if add_bass else 1)
+    data = midi_bytes(pattern, repeats, len(chord_notes) * 4, tempo, num_tracks)
+    return write_midi(data, output_file)
+
+def generate_midi_with_bass(notes_of_chord_progression, output_file, repeats, tempo, add_bass, add_lead):
+    chord_notes, bass_notes = notes_to_midi_with_bass(notes_of_chord_progression)
+    return progression_midi(chord_notes, bass_notes, output_file, repeats, tempo, add_bass, add_lead)
+
+def generate_midi_from_chords(chords, output_file, repeats, tempo, add_bass, add_lead, voicing='fixed'):
+    # Same as generate_midi_with_bass(chords_to_notes(chords), ...), resolved through the chord table
+    chord_notes, bass_notes = progression_to_midi(chords, voicing)
+    return progression_midi(chord_notes, bass_notes, output_file, repeats, tempo, add_bass, add_lead)
+
+def progression_events(chord_notes, bass_notes, tempo, repeats, add_bass, add_lead):
+    # The notes of generate_midi_from_chords as time-ordered (seconds, note_on, channel, pitch, velocity),
+    # produced one repetition at a time so long arrangements never exist in memory as a whole
+    pattern = note_pattern(chord_notes, bass_notes, tempo, add_bass, add_lead)
+    return pattern_progression_events(pattern, len(chord_notes) * 4, tempo, repeats)
+
+def pattern_progression_events(pattern, block_beats, tempo, repeats):
+    # progression_events for a note pattern that is already built
+    ticks, statuses, pitches, velocities = pattern_events(pattern)
+    events = list(zip((ticks / TICKS_PER_BEAT).tolist(), (statuses == 0x90).tolist(), pitches.tolist(),
+                      velocities.tolist()))
+
+    seconds_per_beat = 60 / tempo
+    for z in range(0, repeats * block_beats, block_beats):
+        for beat, note_on, pitch, velocity in events:
+            yield (z + beat) * seconds_per_beat, note_on, 0, pitch, velocity if note_on else 0
+
+def midi_to_mp3_with_drums(midi_file, soundfont, mp3_file, drum_style, tempo, progress=None, drum_volume=0.5):
+    # midi_file: a path or MIDI bytes. Without stems render_arrangement only needs the MIDI and the tempo.
+    from .export import MIX, render_arrangement, write_audio
+
+    progress = progress or (lambda message: None)
+    progress("Synthesizing")
+    samples = render_arrangement({'midi': midi_file, 'tempo': tempo}, soundfont, drum_style, drum_volume)[MIX]
+    progress("Encoding MP3")
+    write_audio(samples, mp3_file, 'mp3')
+
+def render_track(chords, soundfont, tempo, repetitions, drum_style="No", add_bass=False, add_lead=False,
+                 drum_volume=0.5, midi_file=None, instrument=None):
+    # Chord names -> int16 (frames, 2) PCM with drums, through the export stage. The MIDI is also written
+    # to midi_file when given.
+    from .export import MIX, build_arrangement, render_arrangement
+
+    arrangement = build_arrangement(chords, tempo, repetitions, add_bass, add_lead, instrument)
+    if midi_file is not None:
+        write_midi(arrangement['midi'], midi_file)
+    return render_arrangement(arrangement, soundfont, drum_style, drum_volume, instrument=instrument)[MIX]
+
+def soundfont_choose(sf_name):
+    # A name from SOUNDFONTS, or a path to any other .sf2
+    return data_path(SOUNDFONTS.get(sf_name, sf_name))
+
+@contextmanager
+def timed_stage(instrument, stage):
+    # instrument(stage, seconds) is called once the block finishes; no-op when instrument is None
+    if instrument is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        instrument(stage, time.perf_counter() - started)
@@ -0,0 +1,567 @@
+import sys
+import threading
+import time
+
+import numpy as np
+
+from . import synth_backend
+from .chord_table import progression_to_midi
+from .drum_mixer import mix_drums
+from .midi_builder import TICKS_PER_BEAT, pattern_events
+from .pipeline import note_pattern
+from .synth_backend import CHANNELS, SAMPLE_RATE
+from .streaming import WavStreamWriter
+
+# Real-time preview: a producer thread synthesises the song bar by bar, a few milliseconds at a time, into
+# a ring buffer that the audio device callback (or a null/file sink) drains. Only BUFFER_FRAMES of audio
+# are ever rendered ahead, so playback starts after the first block and setting changes are heard from
+# the next bar on.
+BEATS_PER_BAR = 4
+BLOCK_FRAMES = 512
+BUFFER_FRAMES = 4096
+TAIL_SECONDS = 0.5
+PLAYBACK_DEFAULTS = {
+    'chords': (),
+    'soundfont': None,
+    'tempo': 120,
+    'drum_style': "No",
+    'drum_volume': 0.5,
+    'add_bass': False,
+    'add_lead': False,
+    'repetitions': None,
+}
+# Settings that start a new drum/bar grid when they change, and those that need a new note schedule
+GRID_SETTINGS = ('tempo', 'drum_style', 'drum_volume')
+SCHEDULE_SETTINGS = ('chords', 'tempo', 'add_bass', 'add_lead')
+
+
+class RingBuffer:
+    # Single-producer, single-consumer FIFO of int16 (frames, channels). write() blocks while the buffer
+    # is full; read() by default doesn't, it pads with silence and counts an underrun instead.
+
+    def __init__(self, frames, channels=CHANNELS):
+        self.data = np.zeros((frames, channels), dtype=np.int16)
+        self.capacity = frames
+        self.written = 0
+        self.consumed = 0
+        self.underruns = 0
+        self.finished = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def available(self):
+        with self.cond:
+            return self.written - self.consumed
+
+    def write(self, block):
+        # -> False once the buffer has been closed
+        offset = 0
+        while offset < len(block):
+            with self.cond:
+                while not self.closed and self.written - self.consumed == self.capacity:
+                    self.cond.wait()
+                if self.closed:
+                    return False
+                start = self.written % self.capacity
+                n = min(len(block) - offset, self.capacity - (self.written - self.consumed), self.capacity - start)
+                self.data[start:start + n] = block[offset:offset + n]
+                self.written += n
+                self.cond.notify_all()
+            offset += n
+        return True
+
+    def read(self, frames, block=False):
+        # -> (int16 (frames, channels), frames of real audio in it). With block=True waits for the frames
+        # (or the end of the song) instead of padding.
+        out = np.zeros((frames, self.data.shape[1]), dtype=np.int16)
+        with self.cond:
+            while block and not self.finished and self.written - self.consumed < frames:
+                self.cond.wait()
+            n = min(frames, self.written - self.consumed)
+            start = self.consumed % self.capacity
+            head = min(n, self.capacity - start)
+            out[:head] = self.data[start:start + head]
+            out[head:n] = self.data[:n - head]
+            self.consumed += n
+            if n < frames and not self.finished:
+                self.underruns += 1
+            self.cond.notify_all()
+        return (out[:n] if block else out), n
+
+    def finish(self):
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.finished = True
+            self.cond.notify_all()
+
+
+class FluidSynthRenderer:
+    # A synth of its own rather than synth_backend's shared one, which stays locked for a whole render
+    def __init__(self, soundfont, sample_rate=SAMPLE_RATE):
+        self.synth = synth_backend.fluidsynth.Synth(samplerate=float(sample_rate))
+        sfid = self.synth.sfload(soundfont)
+        if sfid == -1:
+            self.synth.delete()
+            raise OSError(f"Could not load SoundFont: {soundfont}")
+        self.synth.program_select(0, sfid, 0, 0)
+
+    def noteon(self, pitch, velocity):
+        self.synth.noteon(0, pitch, velocity)
+
+    def noteoff(self, pitch):
+        self.synth.noteoff(0, pitch)
+
+    def all_notes_off(self):
+        self.synth.cc(0, 123, 0)
+
+    def render(self, frames):
+        return self.synth.get_samples(frames).astype(np.int16, copy=False).reshape(-1, CHANNELS)
+
+    def close(self):
+        self.synth.delete()
+
+
+class ToneRenderer:
+    # A tiny built-in synth (two decaying sine partials per note) for machines without FluidSynth and for
+    # headless tests
+    attack_seconds = 0.005
+    decay_seconds = 1.5
+    release_seconds = 0.08
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.voices = {}
+
+    def noteon(self, pitch, velocity):
+        # pitch -> [frames since note on, amplitude, frame of note off or None]
+        self.voices[pitch] = [0, velocity / 127 * 0.12, None]
+
+    def noteoff(self, pitch):
+        voice = self.voices.get(pitch)
+        if voice is not None and voice[2] is None:
+            voice[2] = voice[0]
+
+    def all_notes_off(self):
+        for pitch in list(self.voices):
+            self.noteoff(pitch)
+
+    def render(self, frames):
+        out = np.zeros(frames, dtype=np.float64)
+        release = self.release_seconds * self.sample_rate
+        for pitch, voice in list(self.voices.items()):
+            position, amplitude, released = voice
+            n = position + np.arange(frames, dtype=np.float64)
+            phase = 2 * np.pi * 440 * 2 ** ((pitch - 69) / 12) * n / self.sample_rate
+            envelope = amplitude * np.minimum(1, n / (self.attack_seconds * self.sample_rate))
+            envelope *= np.exp(-n / (self.decay_seconds * self.sample_rate))
+            if released is not None:
+                envelope *= np.clip(1 - (n - released) / release, 0, 1)
+            out += envelope * (np.sin(phase) + 0.3 * np.sin(2 * phase))
+            voice[0] += frames
+            if released is not None and voice[0] - released >= release:
+                del self.voices[pitch]
+        mono = np.clip(np.rint(out * 32767), -32768, 32767).astype(np.int16)
+        return np.repeat(mono[:, None], CHANNELS, axis=1)
+
+    def close(self):
+        self.voices.clear()
+
+
+def open_renderer(soundfont, sample_rate=SAMPLE_RATE):
+    if soundfont and synth_backend.fluidsynth is not None:
+        return FluidSynthRenderer(soundfont, sample_rate)
+    return ToneRenderer(sample_rate)
+
+
+def bar_schedule(chords, tempo, add_bass=False, add_lead=False):
+    # One list per bar of (beat in bar, note_on, pitch, velocity), in play order. Note-offs on a bar line
+    # open the next bar (the last bar's open the first), ahead of its note-ons.
+    chord_notes, bass_notes = progression_to_midi(chords)
+    ticks, statuses, pitches, velocities = pattern_events(note_pattern(chord_notes, bass_notes, tempo, add_bass, add_lead))
+    bar_ticks = BEATS_PER_BAR * TICKS_PER_BEAT
+    ticks = ticks % (len(chord_notes) * bar_ticks)
+    note_on = statuses == 0x90
+    order = np.lexsort((note_on, ticks))
+    bars = [[] for _ in chord_notes]
+    for tick, on, pitch, velocity in zip(ticks[order].tolist(), note_on[order].tolist(), pitches[order].tolist(),
+                                         velocities[order].tolist()):
+        bar, tick = divmod(tick, bar_ticks)
+        bars[bar].append((tick / TICKS_PER_BEAT, on, pitch, velocity))
+    return bars
+
+
+class PlaybackEngine:
+    # play() starts the song, update() changes settings from the next bar on, stop() ends it. The sink
+    # pulls audio through read() from its own thread or audio callback.
+
+    def __init__(self, sink=None, sample_rate=SAMPLE_RATE, block_frames=BLOCK_FRAMES, buffer_frames=BUFFER_FRAMES,
+                 renderer_factory=open_renderer):
+        self.sink = sink or default_sink()
+        self.sample_rate = sample_rate
+        self.block_frames = block_frames
+        self.buffer_frames = buffer_frames
+        self.renderer_factory = renderer_factory
+        self.frames_played = 0
+        self.error = None
+        self._lock = threading.Lock()
+        self._renderers = {}
+        self._pending = {}
+        self._buffer = None
+        self._producer = None
+        self._on_finished = None
+
+    @property
+    def playing(self):
+        buffer = self._buffer
+        return buffer is not None and not buffer.closed and not (buffer.finished and buffer.available() == 0)
+
+    @property
+    def position(self):
+        return self.frames_played / self.sample_rate
+
+    @property
+    def underruns(self):
+        return self._buffer.underruns if self._buffer is not None else 0
+
+    def renderer(self, soundfont):
+        # Renderers (and the SoundFonts they parsed) are kept for the engine's lifetime
+        with self._lock:
+            renderer = self._renderers.get(soundfont)
+        if renderer is None:
+            renderer = self.renderer_factory(soundfont, self.sample_rate)
+            with self._lock:
+                renderer = self._renderers.setdefault(soundfont, renderer)
+        return renderer
+
+    def preload(self, soundfont):
+        # Parses a SoundFont in the background so the next play() or update() using it starts at once
+        threading.Thread(target=self._preload, args=(soundfont,), daemon=True).start()
+
+    def _preload(self, soundfont):
+        try:
+            self.renderer(soundfont)
+        except Exception:
+            # Keep playing with the SoundFont we have
+            with self._lock:
+                if self._pending.get('soundfont') == soundfont:
+                    del self._pending['soundfont']
+
+    def play(self, chords, on_finished=None, **settings):
+        # repetitions=None loops until stop()
+        self.stop()
+        settings = {**PLAYBACK_DEFAULTS, **settings, 'chords': tuple(chords)}
+        if not settings['chords']:
+            raise ValueError("Nothing to play")
+        renderer = self.renderer(settings['soundfont'])
+        renderer.all_notes_off()
+        with self._lock:
+            self._pending = {}
+        self.frames_played = 0
+        self.error = None
+        self._on_finished = on_finished
+        self._buffer = RingBuffer(self.buffer_frames)
+        self._producer = threading.Thread(target=self._produce, args=(self._buffer, settings), daemon=True)
+        self._producer.start()
+        self.sink.start(self)
+
+    def update(self, **settings):
+        # Takes effect at the next bar line. A new SoundFont is loaded off the audio path first; until it is
+        # ready the old one keeps playing.
+        unknown = set(settings) - set(PLAYBACK_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown playback settings: {', '.join(sorted(unknown))}")
+        if 'chords' in settings:
+            settings['chords'] = tuple(settings['chords'])
+        if settings.get('soundfont') is not None:
+            self.preload(settings['soundfont'])
+        with self._lock:
+            self._pending.update(settings)
+
+    def stop(self):
+        buffer, producer = self._buffer, self._producer
+        if buffer is None:
+            return
+        buffer.close()
+        self.sink.stop()
+        if producer is not None and producer is not threading.current_thread():
+            producer.join()
+        self._producer = None
+
+    def wait(self, timeout=None):
+        # Blocks until the song has been played to the end (or stopped); -> True if it has
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.playing:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def read(self, frames, block=False):
+        # For the sink. An audio callback must not block: it gets silence for whatever isn't rendered yet.
+        # -> int16 (frames, channels), or None once everything has been played
+        buffer = self._buffer
+        if buffer is None:
+            return None
+        block, n = buffer.read(frames, block)
+        if n == 0 and buffer.finished:
+            return None
+        self.frames_played += n
+        return block
+
+    def finished(self):
+        # Called by the sink once read() has returned None
+        if self._on_finished is not None:
+            self._on_finished(self)
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            renderers = list(self._renderers.values())
+            self._renderers.clear()
+        for renderer in renderers:
+            renderer.close()
+
+    def _take_pending(self, settings):
+        # -> (settings, what changed) with the updates made since the last bar line
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending.get('soundfont') is not None:
+            with self._lock:
+                if pending['soundfont'] not in self._renderers:
+                    # Still loading: try again at the next bar line
+                    self._pending.setdefault('soundfont', pending.pop('soundfont'))
+        changed = {name for name, value in pending.items() if settings.get(name) != value}
+        return {**settings, **pending}, changed
+
+    def _produce(self, buffer, settings):
+        try:
+            self._render_song(buffer, settings)
+        except Exception as e:
+            self.error = e
+        finally:
+            buffer.finish()
+
+    def _render_song(self, buffer, settings):
+        renderer = self.renderer(settings['soundfont'])
+        bars = bar_schedule(settings['chords'], settings['tempo'], settings['add_bass'], settings['add_lead'])
+        position = 0
+        grid_start = 0
+        grid_bar = 0
+        bar = 0
+        played = 0
+
+        while True:
+            settings, changed = self._take_pending(settings)
+            if changed:
+                renderer.all_notes_off()
+                renderer = self.renderer(settings['soundfont'])
+            if changed & set(SCHEDULE_SETTINGS):
+                bars = bar_schedule(settings['chords'], settings['tempo'], settings['add_bass'], settings['add_lead'])
+            if 'chords' in changed:
+                bar = played = 0
+            if changed & set(GRID_SETTINGS):
+                grid_start, grid_bar = position, 0
+            if settings['repetitions'] is not None and played >= len(bars) * settings['repetitions']:
+                break
+
+            # Bar lines sit on the same rounded frames mix_drums lays the drum bars on
+            bar_frames = BEATS_PER_BAR * 60 * self.sample_rate / settings['tempo']
+            bar_start = grid_start + int(np.rint(grid_bar * bar_frames))
+            bar_end = grid_start + int(np.rint((grid_bar + 1) * bar_frames))
+            events = [(bar_start + int(np.rint(beat * bar_frames / BEATS_PER_BAR)), on, pitch, velocity)
+                      for beat, on, pitch, velocity in bars[bar]]
+            for frame, on, pitch, velocity in events + [(bar_end, None, None, None)]:
+                while position < min(frame, bar_end):
+                    n = min(self.block_frames, min(frame, bar_end) - position)
+                    block = mix_drums(renderer.render(n), settings['drum_style'], settings['tempo'],
+                                      settings['drum_volume'], self.sample_rate, start_frame=position - grid_start)
+                    if not buffer.write(block):
+                        return
+                    position += n
+                if on:
+                    renderer.noteon(pitch, velocity)
+                elif on is not None:
+                    renderer.noteoff(pitch)
+
+            bar = (bar + 1) % len(bars)
+            grid_bar += 1
+            played += 1
+
+        renderer.all_notes_off()
+        tail = int(TAIL_SECONDS * self.sample_rate)
+        while tail > 0:
+            n = min(self.block_frames, tail)
+            if not buffer.write(renderer.render(n)):
+                return
+            tail -= n
+
+
+class ThreadSink:
+    # Drains the engine from a thread of its own, in real time or as fast as the engine renders
+    def __init__(self, block_frames=BLOCK_FRAMES, realtime=False):
+        self.block_frames = block_frames
+        self.realtime = realtime
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self, engine):
+        self.stop()
+        self.stopping.clear()
+        self.open(engine)
+        self.thread = threading.Thread(target=self._drain, args=(engine,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            self.stopping.set()
+            thread.join()
+            self.thread = None
+
+    def _drain(self, engine):
+        started = time.monotonic()
+        frames = 0
+        try:
+            while not self.stopping.is_set():
+                block = engine.read(self.block_frames, block=not self.realtime)
+                if block is None:
+                    engine.finished()
+                    break
+                self.consume(block)
+                frames += len(block)
+                if self.realtime:
+                    delay = started + frames / engine.sample_rate - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            self.close()
+
+    def open(self, engine):
+        pass
+
+    def consume(self, block):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullSink(ThreadSink):
+    # Discards the audio; counts what it was given
+    def open(self, engine):
+        self.frames = 0
+
+    def consume(self, block):
+        self.frames += len(block)
+
+
+class FileSink(ThreadSink):
+    # Writes everything played to a WAV file, underrun silence included
+    def __init__(self, path, block_frames=BLOCK_FRAMES, realtime=False):
+        super().__init__(block_frames, realtime)
+        self.path = path
+        self.writer = None
+
+    def open(self, engine):
+        self.writer = WavStreamWriter(self.path, engine.sample_rate)
+
+    def consume(self, block):
+        self.writer.write(block)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class SoundDeviceSink:
+    # The audio device's own callback pulls from the engine; needs the optional sounddevice package
+    def __init__(self, block_frames=BLOCK_FRAMES, device=None):
+        try:
+            import sounddevice
+        except ImportError:
+            raise OSError("sounddevice is not installed") from None
+        self.sounddevice = sounddevice
+        self.block_frames = block_frames
+        self.device = device
+        self.stream = None
+        self.stopping = False
+
+    def start(self, engine):
+        self.stop()
+        sounddevice = self.sounddevice
+
+        def callback(outdata, frames, time_info, status):
+            block = engine.read(frames)
+            if block is None:
+                outdata.fill(0)
+                raise sounddevice.CallbackStop
+            outdata[:] = block
+
+        def finished_callback():
+            if not self.stopping:
+                engine.finished()
+
+        self.stopping = False
+        self.stream = sounddevice.OutputStream(samplerate=engine.sample_rate, channels=CHANNELS, dtype='int16',
+                                               blocksize=self.block_frames, latency='low', device=self.device,
+                                               callback=callback, finished_callback=finished_callback)
+        self.stream.start()
+
+    def stop(self):
+        if self.stream is not None:
+            self.stopping = True
+            self.stream.abort()
+            self.stream.close()
+            self.stream = None
+
+
+class PygameSink(ThreadSink):
+    # Keeps a pygame.mixer channel's queue topped up with short Sounds. The mixer must have been
+    # initialised with the engine's sample rate, 16-bit samples and two channels.
+    def __init__(self, block_frames=2048):
+        import pygame
+
+        if not pygame.mixer.get_init():
+            raise OSError("pygame.mixer is not initialised")
+        super().__init__(block_frames)
+        self.pygame = pygame
+        self.channel = None
+
+    def open(self, engine):
+        self.channel = self.pygame.mixer.find_channel(True)
+
+    def consume(self, block):
+        sound = self.pygame.sndarray.make_sound(np.ascontiguousarray(block))
+        if not self.channel.get_busy():
+            self.channel.play(sound)
+            return
+        while self.channel.get_queue() is not None and not self.stopping.is_set():
+            time.sleep(0.002)
+        self.channel.queue(sound)
+
+    def close(self):
+        if self.channel is not None and self.stopping.is_set():
+            self.channel.stop()
+
+
+def default_sink():
+    # sounddevice if it is installed and finds an output device, else pygame when the application has
+    # already set up its mixer (pygame is never imported here), else a real-time NullSink
+    try:
+        import sounddevice
+
+        sounddevice.check_output_settings(channels=CHANNELS, dtype='int16', samplerate=SAMPLE_RATE)
+        return SoundDeviceSink()
+    except Exception:
+        # Not installed, no PortAudio library, or no usable output device
+        pass
+    pygame = sys.modules.get('pygame')
+    if pygame is not None and pygame.mixer.get_init():
+        return PygameSink()
+    return NullSink(realtime=True)
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'makethemusic_renders')
+
+
+def _soundfont_identity(soundfont):
+    # Path plus size and mtime, so replacing a .sf2 under the same name invalidates its renders
+    try:
+        stat = os.stat(soundfont)
+        return [os.path.abspath(soundfont), stat.st_size, int(stat.st_mtime)]
+    except OSError:
+        return [soundfont]
+
+
+def render_key(chords, tempo, repetitions, soundfont, drum_style, add_bass, add_lead, drum_volume=0.5, fmt='mp3'):
+    settings = {
+        'chords': list(chords),
+        'tempo': tempo,
+        'repetitions': repetitions,
+        'soundfont': _soundfont_identity(soundfont),
+        'drum_style': drum_style,
+        'drum_volume': drum_volume,
+        'add_bass': bool(add_bass),
+        'add_lead': bool(add_lead),
+        'format': fmt,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    # Rendered audio by render_key(): an in-memory LRU of bytes in front of a directory of files.
+    # Both tiers are bounded in bytes and evict least recently used entries first.
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_memory_bytes=64 * 2**20, max_disk_bytes=512 * 2**20, fmt='mp3'):
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.fmt = fmt
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.{self.fmt}')
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._memory:
+                return True
+        return self.directory is not None and os.path.exists(self._path(key))
+
+    def _remember(self, key, data):
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _evict_disk(self, keep=None):
+        entries = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if path == keep or filename.endswith('.part'):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            total += os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def get_bytes(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        path = self.get_path(key)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        self._remember(key, data)
+        return data
+
+    def get_path(self, key):
+        # A file holding the cached render, written out from memory if it only lives there
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        with self._lock:
+            data = self._memory.get(key)
+        if data is None:
+            return None
+        return self._write(key, data)
+
+    def _write(self, key, data):
+        path = self._path(key)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._evict_disk(keep=path)
+        return path
+
+    def put_bytes(self, key, data):
+        self._remember(key, data)
+        if self.directory is not None:
+            return self._write(key, data)
+        return None
+
+    def put_file(self, key, source_path, move=True):
+        with open(source_path, 'rb') as f:
+            data = f.read()
+        self._remember(key, data)
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        if move:
+            shutil.move(source_path, path)
+        else:
+            shutil.copyfile(source_path, path)
+        self._evict_disk(keep=path)
+        return path
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self.directory is not None:
+            for filename in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, filename))
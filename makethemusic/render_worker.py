@@ -0,0 +1,128 @@
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    # Handle passed as the first argument to every job function. progress() doubles as the
+    # cancellation point: it raises JobCancelled once a newer job replaced this one.
+
+    def __init__(self, worker, channel, on_progress=None):
+        self.worker = worker
+        self.channel = channel
+        self.on_progress = on_progress
+        self.future = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def post(self, callback, *args):
+        # Runs callback on the UI thread, unless the job is stale by the time it gets there
+        self.worker.post(lambda: None if self.cancelled else callback(*args))
+
+    def progress(self, message, fraction=None):
+        self.check()
+        if self.on_progress is not None:
+            self.post(self.on_progress, message, fraction)
+
+
+class RenderWorker:
+    # Thread pool for generation and rendering. Results and progress are handed back through a
+    # queue that the Tk mainloop drains with root.after, so widgets are only touched on the UI thread.
+    # Submitting on a channel cancels the job already running on that channel.
+
+    def __init__(self, root=None, max_workers=2, poll_ms=50):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='render')
+        self._callbacks = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._root = None
+        self.poll_ms = poll_ms
+        if root is not None:
+            self.attach(root)
+
+    def attach(self, root):
+        self._root = root
+        root.after(self.poll_ms, self._poll)
+
+    def post(self, callback):
+        if self._root is None:
+            callback()
+        else:
+            self._callbacks.put(callback)
+
+    def _poll(self):
+        while True:
+            try:
+                callback = self._callbacks.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+        self._root.after(self.poll_ms, self._poll)
+
+    def submit(self, fn, *args, channel=None, on_done=None, on_error=None, on_progress=None):
+        job = Job(self, channel, on_progress)
+        if channel is not None:
+            with self._lock:
+                previous = self._jobs.get(channel)
+                self._jobs[channel] = job
+            if previous is not None:
+                previous.cancel()
+
+        def run():
+            try:
+                result = fn(job, *args)
+            except JobCancelled:
+                return
+            except Exception as e:
+                if on_error is not None:
+                    job.post(on_error, e)
+                else:
+                    traceback.print_exc()
+                return
+            finally:
+                with self._lock:
+                    if self._jobs.get(channel) is job:
+                        del self._jobs[channel]
+            if on_done is not None:
+                job.post(on_done, result)
+
+        job.future = self._executor.submit(run)
+        return job
+
+    def cancel(self, channel):
+        with self._lock:
+            job = self._jobs.pop(channel, None)
+        if job is not None:
+            job.cancel()
+
+    def busy(self, channel=None):
+        with self._lock:
+            return bool(self._jobs) if channel is None else channel in self._jobs
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            self._jobs.clear()
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
@@ -0,0 +1,383 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import model_registry, synth_backend
+from .batch import _as_bool
+from .chord_generation import generate_chords_batch
+from .drum_mixer import DRUM_STYLES
+from .pipeline import SOUNDFONTS, soundfont_choose
+from .render_cache import RenderCache, render_key
+from .streaming import iter_encoded, stream_track
+
+CONTENT_TYPES = {'mp3': 'audio/mpeg', 'wav': 'audio/wav', 'ogg': 'audio/ogg', 'flac': 'audio/flac'}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_BODY_BYTES = 1 << 20
+MAX_NUM_CHORDS = 64
+MAX_TEMPO = 400
+MAX_REPETITIONS = 256
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class GenerationBatcher:
+    # Collects /generate and /render chord requests for up to window_ms (or max_batch rows) and runs
+    # each (mood, num_chords) group through a single generate_chords_batch call.
+
+    def __init__(self, executor, window_ms=5, max_batch=512, max_pending=1024):
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.batches = 0
+
+    async def generate(self, mood, start_chord, n=1, num_chords=3):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((mood, num_chords, start_chord, n, future))
+        except asyncio.QueueFull:
+            raise HTTPError(503, "Too many pending generation requests") from None
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            rows = requests[0][3]
+            deadline = loop.time() + self.window
+            while rows < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                rows += request[3]
+
+            groups = {}
+            for request in requests:
+                groups.setdefault(request[:2], []).append(request)
+            for (mood, num_chords), group in groups.items():
+                await self._run_group(loop, mood, num_chords, group)
+            self.batches += 1
+
+    async def _run_group(self, loop, mood, num_chords, group):
+        start_chords = [start for _, _, start, n, _ in group for _ in range(n)]
+        try:
+            progressions = await loop.run_in_executor(
+                self.executor, lambda: generate_chords_batch(mood, start_chords, len(start_chords), num_chords,
+                                                             use_table=True))
+        except Exception as e:
+            if len(group) > 1:
+                # Retry one request at a time so only the one that caused the failure gets the error
+                for request in group:
+                    await self._run_group(loop, mood, num_chords, [request])
+                return
+            for *_, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        offset = 0
+        for _, _, _, n, future in group:
+            if not future.done():
+                future.set_result(progressions[offset:offset + n])
+            offset += n
+
+
+class ChordService:
+    # Offline HTTP/1.1 service on asyncio streams:
+    #   GET  /health    models, SoundFonts and queue depth
+    #   POST /generate  {"mood", "start_chord", "num_chords", "n"} -> {"progressions": [...]}
+    #   POST /render    {"chords" or "mood"/"start_chord", "tempo", "repetitions", "synth", "drums",
+    #                    "bass", "lead", "format"} -> audio, streamed with chunked transfer encoding
+
+    def __init__(self, render_concurrency=2, max_waiting_renders=16, window_ms=5, max_batch=512, max_pending=1024,
+                 chunk_size=64 * 1024, cache_bytes=128 * 2**20, max_cached_render=4 * 2**20):
+        self.executor = ThreadPoolExecutor(max_workers=render_concurrency + 1, thread_name_prefix='service')
+        self.batcher = GenerationBatcher(self.executor, window_ms, max_batch, max_pending)
+        self.render_slots = asyncio.Semaphore(render_concurrency)
+        self.max_waiting_renders = max_waiting_renders
+        self.waiting_renders = 0
+        self.active_renders = 0
+        self.chunk_size = chunk_size
+        self.cache = RenderCache(directory=None, max_memory_bytes=cache_bytes)
+        # Only renders up to this size are kept for the cache while they stream; longer ones stay constant-memory
+        self.max_cached_render = min(max_cached_render, cache_bytes)
+        self.started = time.time()
+
+    def warm_up(self):
+        model_registry.register_model_dir()
+        model_registry.warm_models(background=False, tables=True)
+        if synth_backend.in_process_available():
+            for name in SOUNDFONTS:
+                soundfont = soundfont_choose(name)
+                if os.path.exists(soundfont):
+                    synth_backend.get_synth(soundfont)
+                    synth_backend.warm_stream_synths(soundfont)
+
+    async def serve(self, host='127.0.0.1', port=8765):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self.warm_up)
+        batcher = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await self.read_request(reader)
+            if path == '/health' and method == 'GET':
+                await self.send_json(writer, 200, self.health())
+            elif path == '/generate' and method == 'POST':
+                await self.send_json(writer, 200, await self.generate(self.parse_json(body)))
+            elif path == '/render' and method == 'POST':
+                await self.render(writer, self.parse_json(body))
+            elif path in ('/health', '/generate', '/render'):
+                raise HTTPError(405, f"{method} is not supported on {path}")
+            else:
+                raise HTTPError(404, f"No such endpoint: {path}")
+        except HTTPError as e:
+            await self.send_json(writer, e.status, {'error': str(e)})
+        except (ValueError, KeyError, TypeError) as e:
+            await self.send_json(writer, 400, {'error': str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            await self.send_json(writer, 500, {'error': f'{type(e).__name__}: {e}'})
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').strip()
+        if not request_line:
+            raise ConnectionError("Empty request")
+        method, target, _ = request_line.split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target.split('?', 1)[0], body
+
+    def parse_json(self, body):
+        try:
+            data = json.loads(body or b'{}')
+        except json.JSONDecodeError as e:
+            raise HTTPError(400, f"Invalid JSON: {e}") from None
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Expected a JSON object")
+        return data
+
+    async def send_json(self, writer, status, data):
+        body = json.dumps(data).encode('utf-8')
+        writer.write(self.head(status, {'Content-Type': 'application/json', 'Content-Length': str(len(body))}) + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def head(self, status, headers):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}'] + [f'{k}: {v}' for k, v in headers.items()]
+        lines.append('Connection: close')
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def health(self):
+        return {
+            'status': 'ok',
+            'uptime': round(time.time() - self.started, 1),
+            'moods': model_registry.available_moods(),
+            'loaded_moods': [mood for mood in model_registry.available_moods() if model_registry.is_loaded(mood)],
+            'in_process_synth': synth_backend.in_process_available(),
+            'pending_generations': self.batcher.queue.qsize(),
+            'generation_batches': self.batcher.batches,
+            'active_renders': self.active_renders,
+            'waiting_renders': self.waiting_renders,
+        }
+
+    def generation_request(self, data):
+        # Checked here rather than in the batcher so a bad request never reaches (and fails) a batch
+        mood = data.get('mood', 'happy')
+        if mood not in model_registry.available_moods():
+            raise HTTPError(404, f"Unknown mood: {mood}")
+        start_chord = data.get('start_chord')
+        if start_chord is not None and not isinstance(start_chord, str):
+            raise HTTPError(400, "start_chord must be a chord name")
+        num_chords = int(data.get('num_chords', 3))
+        if not 1 <= num_chords <= MAX_NUM_CHORDS:
+            raise HTTPError(400, f"num_chords must be between 1 and {MAX_NUM_CHORDS}")
+        return mood, start_chord or 'Any', num_chords
+
+    async def generate(self, data):
+        n = int(data.get('n', 1))
+        if not 1 <= n <= self.batcher.max_batch:
+            raise HTTPError(400, f"n must be between 1 and {self.batcher.max_batch}")
+        mood, start_chord, num_chords = self.generation_request(data)
+        progressions = await self.batcher.generate(mood, start_chord, n, num_chords)
+        return {'progressions': progressions}
+
+    async def render(self, writer, data):
+        fmt = data.get('format', 'mp3').lower()
+        if fmt not in CONTENT_TYPES:
+            raise HTTPError(400, f"Unsupported format: {fmt}")
+        settings = self.render_settings(data)
+        chords = data.get('chords')
+        if isinstance(chords, str):
+            chords = chords.split()
+        if chords and (not isinstance(chords, list) or not all(isinstance(chord, str) for chord in chords)):
+            raise HTTPError(400, "chords must be a list of chord names")
+        if not chords:
+            mood, start_chord, num_chords = self.generation_request(data)
+            chords = (await self.batcher.generate(mood, start_chord, 1, num_chords))[0]
+
+        key = render_key(chords, fmt=fmt, **settings)
+        audio = self.cache.get_bytes(key)
+        if audio is not None:
+            await self.send_chunked(writer, fmt, chords, self.cached_chunks(audio))
+            return
+
+        if self.waiting_renders >= self.max_waiting_renders:
+            raise HTTPError(503, "Render queue is full")
+        self.waiting_renders += 1
+        try:
+            await self.render_slots.acquire()
+        finally:
+            self.waiting_renders -= 1
+        self.active_renders += 1
+        try:
+            await self.stream_render(writer, chords, settings, fmt, key)
+        finally:
+            self.active_renders -= 1
+            self.render_slots.release()
+
+    def render_settings(self, data):
+        # Everything that would otherwise only fail once the 200 and the first audio bytes are out.
+        # synth must name one of the shipped SoundFonts; a path from a client is never handed to FluidSynth.
+        synth = data.get('synth', 'Piano')
+        if not isinstance(synth, str) or synth not in SOUNDFONTS or not os.path.isfile(soundfont_choose(synth)):
+            raise HTTPError(400, f"Unknown synth: {synth}")
+        settings = {
+            'tempo': int(data.get('tempo', 120)),
+            'repetitions': int(data.get('repetitions', 1)),
+            'soundfont': soundfont_choose(synth),
+            'drum_style': data.get('drums', 'No'),
+            'add_bass': _as_bool(data.get('bass', False)),
+            'add_lead': _as_bool(data.get('lead', False)),
+            'drum_volume': float(data.get('drum_volume', 0.5)),
+        }
+        if not 1 <= settings['tempo'] <= MAX_TEMPO:
+            raise HTTPError(400, f"tempo must be between 1 and {MAX_TEMPO}")
+        if not 1 <= settings['repetitions'] <= MAX_REPETITIONS:
+            raise HTTPError(400, f"repetitions must be between 1 and {MAX_REPETITIONS}")
+        if settings['drum_style'] != "No" and settings['drum_style'] not in DRUM_STYLES:
+            raise HTTPError(400, f"Unknown drum style: {settings['drum_style']}")
+        return settings
+
+    async def stream_render(self, writer, chords, settings, fmt, key):
+        # The render runs bar by bar on a worker thread and hands encoded chunks over a small bounded
+        # queue, so a slow client slows the renderer down instead of piling audio up in memory
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=8)
+        stopped = threading.Event()
+
+        def produce():
+            blocks = stream_track(chords, settings['soundfont'], settings['tempo'], settings['repetitions'],
+                                  settings['drum_style'], settings['add_bass'], settings['add_lead'],
+                                  settings['drum_volume'])
+            encoded = iter_encoded(blocks, fmt)
+            try:
+                for chunk in encoded:
+                    if stopped.is_set():
+                        return
+                    asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+                end = None
+            except Exception as e:
+                end = e
+            finally:
+                encoded.close()
+            if not stopped.is_set():
+                asyncio.run_coroutine_threadsafe(chunks.put(StreamEnd(end)), loop).result()
+
+        producer = loop.run_in_executor(self.executor, produce)
+
+        async def received():
+            kept = []
+            kept_bytes = 0
+            while True:
+                chunk = await chunks.get()
+                if isinstance(chunk, StreamEnd):
+                    if chunk.error is not None:
+                        raise chunk.error
+                    break
+                if kept is not None:
+                    kept.append(chunk)
+                    kept_bytes += len(chunk)
+                    if kept_bytes > self.max_cached_render:
+                        kept = None
+                yield chunk
+            if kept is not None:
+                self.cache.put_bytes(key, b''.join(kept))
+
+        try:
+            await self.send_chunked(writer, fmt, chords, received())
+        finally:
+            stopped.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+            await producer
+
+    async def cached_chunks(self, audio):
+        for i in range(0, len(audio), self.chunk_size):
+            yield audio[i:i + self.chunk_size]
+
+    async def send_chunked(self, writer, fmt, chords, chunks):
+        # Waits for the first chunk before sending headers so failures that happen up front still get a
+        # proper error status; a failure after that can only cut the response short
+        first = await anext(chunks, b'')
+        writer.write(self.head(200, {'Content-Type': CONTENT_TYPES[fmt], 'Transfer-Encoding': 'chunked',
+                                     'X-Chords': ' '.join(chords)}))
+        chunk = first
+        while chunk is not None:
+            if chunk:
+                writer.write(f'{len(chunk):x}\r\n'.encode('latin-1') + chunk + b'\r\n')
+                await writer.drain()
+            try:
+                chunk = await anext(chunks, None)
+            except Exception as e:
+                writer.transport.abort()
+                raise ConnectionResetError(f"Render failed mid-stream: {e}") from e
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+class StreamEnd:
+    def __init__(self, error=None):
+        self.error = error
+
+
+def run_service(host='127.0.0.1', port=8765, **options):
+    service = ChordService(**options)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,191 @@
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+
+from .drum_mixer import mix_drums
+from .pipeline import pattern_progression_events
+from .synth_backend import CHANNELS, SAMPLE_RATE, in_process_available, stream_events_to_pcm, stream_midi_with_subprocess
+
+FFMPEG_FORMATS = {
+    'mp3': ('mp3', ['-codec:a', 'libmp3lame']),
+    'ogg': ('ogg', ['-codec:a', 'libvorbis']),
+    'flac': ('flac', ['-codec:a', 'flac']),
+}
+# Formats a bitrate such as '192k' applies to; FLAC is lossless and WAV is raw PCM
+BITRATE_FORMATS = ('mp3', 'ogg')
+STREAMING_DATA_SIZE = 0xFFFFFFFF - 36
+
+
+def stream_track(chords, soundfont, tempo, repetitions, drum_style="No", add_bass=False, add_lead=False,
+                 drum_volume=0.5, sample_rate=SAMPLE_RATE, block_frames=None):
+    # Yields the finished song as int16 (frames, 2) blocks, one bar each by default. Memory stays
+    # constant whatever the number of repetitions.
+    from .export import build_arrangement  # export encodes through this module
+
+    arrangement = build_arrangement(chords, tempo, repetitions, add_bass, add_lead)
+    yield from stream_arrangement(arrangement, soundfont, drum_style, drum_volume, sample_rate, block_frames)
+
+
+def stream_arrangement(arrangement, soundfont, drum_style="No", drum_volume=0.5, sample_rate=SAMPLE_RATE,
+                       block_frames=None):
+    # stream_track for an export.build_arrangement result: the in-process synth plays its note pattern and
+    # the fluidsynth CLI fallback its MIDI, so neither is built again
+    tempo = arrangement['tempo']
+    if block_frames is None:
+        block_frames = int(round(4 * 60 * sample_rate / tempo))
+
+    if in_process_available():
+        events = pattern_progression_events(arrangement['pattern'], arrangement['block_beats'], tempo,
+                                            arrangement['repetitions'])
+        blocks = stream_events_to_pcm(events, soundfont, sample_rate, block_frames)
+    else:
+        blocks = stream_midi_with_subprocess(arrangement['midi'], soundfont, sample_rate, block_frames)
+
+    position = 0
+    for block in blocks:
+        yield mix_drums(block, drum_style, tempo, drum_volume, sample_rate, start_frame=position)
+        position += len(block)
+
+
+def wav_header(sample_rate=SAMPLE_RATE, channels=CHANNELS, data_size=STREAMING_DATA_SIZE):
+    # 16-bit PCM header; the default data size marks a stream whose length is not known up front
+    byte_rate = sample_rate * channels * 2
+    return (b'RIFF' + struct.pack('<I', min(data_size + 36, 0xFFFFFFFF)) + b'WAVE'
+            + b'fmt ' + struct.pack('<IHHIIHH', 16, 1, channels, sample_rate, byte_rate, channels * 2, 16)
+            + b'data' + struct.pack('<I', data_size))
+
+
+def _ffmpeg():
+    executable = shutil.which('ffmpeg') or shutil.which('avconv')
+    if executable is None:
+        raise OSError("ffmpeg is needed to encode mp3, ogg and flac")
+    return executable
+
+
+def _ffmpeg_command(fmt, output, sample_rate, channels, bitrate=None):
+    container, codec = FFMPEG_FORMATS[fmt]
+    command = [_ffmpeg(), '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels), '-i', 'pipe:0', *codec]
+    if bitrate and fmt in BITRATE_FORMATS:
+        command += ['-b:a', bitrate]
+    return command + ['-f', container, output]
+
+
+class WavStreamWriter:
+    def __init__(self, path, sample_rate=SAMPLE_RATE, channels=CHANNELS):
+        self.file = open(path, 'wb')
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.data_size = 0
+        self.file.write(wav_header(sample_rate, channels))
+
+    def write(self, block):
+        data = block.astype('<i2', copy=False).tobytes()
+        self.file.write(data)
+        self.data_size += len(data)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(wav_header(self.sample_rate, self.channels, self.data_size))
+        self.file.close()
+
+
+class FfmpegStreamWriter:
+    # Pipes raw PCM into an ffmpeg process that encodes straight into the output file
+    def __init__(self, path, fmt, sample_rate=SAMPLE_RATE, channels=CHANNELS, bitrate=None):
+        self.process = subprocess.Popen(_ffmpeg_command(fmt, path, sample_rate, channels, bitrate),
+                                        stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, block):
+        self.process.stdin.write(block.astype('<i2', copy=False).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        error = self.process.stderr.read().decode('utf-8', 'replace')
+        if self.process.wait() != 0:
+            raise OSError(f"ffmpeg failed: {error.strip()}")
+
+
+def open_stream_writer(path, fmt=None, sample_rate=SAMPLE_RATE, channels=CHANNELS, bitrate=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt == 'wav':
+        return WavStreamWriter(path, sample_rate, channels)
+    if fmt in FFMPEG_FORMATS:
+        return FfmpegStreamWriter(path, fmt, sample_rate, channels, bitrate)
+    raise ValueError(f"Unsupported audio format: {fmt}")
+
+
+def export_stream(blocks, outputs, sample_rate=SAMPLE_RATE, channels=CHANNELS, bitrate=None):
+    # outputs: list of paths (format from the extension) or {format: path}; every block goes to all of them
+    if not isinstance(outputs, dict):
+        outputs = {os.path.splitext(path)[1].lstrip('.').lower(): path for path in outputs}
+    writers = [open_stream_writer(path, fmt, sample_rate, channels, bitrate) for fmt, path in outputs.items()]
+    frames = 0
+    try:
+        for block in blocks:
+            for writer in writers:
+                writer.write(block)
+            frames += len(block)
+    finally:
+        for writer in writers:
+            writer.close()
+    return frames
+
+
+def iter_encoded(blocks, fmt, sample_rate=SAMPLE_RATE, channels=CHANNELS, bitrate=None):
+    # Encoded bytes as they come out of the encoder, for live playback or network streaming
+    if fmt == 'wav':
+        # The header only goes out once the first block has rendered, so a render that fails at once
+        # fails before anything has been sent
+        blocks = iter(blocks)
+        first = next(blocks, None)
+        yield wav_header(sample_rate, channels)
+        if first is None:
+            return
+        yield first.astype('<i2', copy=False).tobytes()
+        for block in blocks:
+            yield block.astype('<i2', copy=False).tobytes()
+        return
+    if fmt not in FFMPEG_FORMATS:
+        raise ValueError(f"Unsupported audio format: {fmt}")
+
+    process = subprocess.Popen(_ffmpeg_command(fmt, 'pipe:1', sample_rate, channels, bitrate),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    chunks = queue.Queue()
+
+    def read_output():
+        while True:
+            chunk = process.stdout.read1(65536)
+            if not chunk:
+                break
+            chunks.put(chunk)
+        chunks.put(None)
+
+    reader = threading.Thread(target=read_output, daemon=True)
+    reader.start()
+    finished = False
+    try:
+        for block in blocks:
+            process.stdin.write(block.astype('<i2', copy=False).tobytes())
+            while not finished and not chunks.empty():
+                chunk = chunks.get_nowait()
+                if chunk is None:
+                    finished = True
+                else:
+                    yield chunk
+        process.stdin.close()
+        while not finished:
+            chunk = chunks.get()
+            if chunk is None:
+                finished = True
+            else:
+                yield chunk
+        if process.wait() != 0:
+            raise OSError(f"ffmpeg exited with code {process.returncode}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
@@ -0,0 +1,252 @@
+import io
+import os
+import subprocess
+import tempfile
+import threading
+import wave
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fluidsynth
+except ImportError:
+    fluidsynth = None
+
+try:
+    import mido
+except ImportError:
+    mido = None
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+# Streaming renders hold a synth for as long as their consumer takes to read the song, so they never use
+# the shared one: each takes a private synth from a small idle pool per SoundFont (or loads a new one)
+STREAM_POOL_SIZE = 2
+
+_synths = {}
+_stream_synths = {}
+_synths_lock = threading.Lock()
+
+
+def in_process_available():
+    return fluidsynth is not None and mido is not None
+
+
+def _load_synth(soundfont, sample_rate):
+    synth = fluidsynth.Synth(samplerate=float(sample_rate))
+    sfid = synth.sfload(soundfont)
+    if sfid == -1:
+        synth.delete()
+        raise OSError(f"Could not load SoundFont: {soundfont}")
+    return synth, sfid
+
+
+def get_synth(soundfont, sample_rate=SAMPLE_RATE):
+    # One resident Synth per (SoundFont, sample rate); the .sf2 is parsed only the first time
+    key = (os.path.abspath(soundfont), sample_rate)
+    with _synths_lock:
+        entry = _synths.get(key)
+        if entry is None:
+            entry = _load_synth(soundfont, sample_rate) + (threading.Lock(),)
+            _synths[key] = entry
+        return entry
+
+
+@contextmanager
+def stream_synth(soundfont, sample_rate=SAMPLE_RATE):
+    # -> (synth, sfid) for this caller alone; it goes back to the pool afterwards, or is deleted when
+    # STREAM_POOL_SIZE synths are already idle
+    key = (os.path.abspath(soundfont), sample_rate)
+    with _synths_lock:
+        idle = _stream_synths.get(key)
+        entry = idle.pop() if idle else None
+    if entry is None:
+        entry = _load_synth(soundfont, sample_rate)
+    try:
+        yield entry
+    finally:
+        with _synths_lock:
+            idle = _stream_synths.setdefault(key, [])
+            if len(idle) < STREAM_POOL_SIZE:
+                idle.append(entry)
+                entry = None
+        if entry is not None:
+            entry[0].delete()
+
+
+def warm_stream_synths(soundfont, sample_rate=SAMPLE_RATE):
+    # Loads one pooled streaming synth up front so the first stream does not parse the .sf2
+    with stream_synth(soundfont, sample_rate):
+        pass
+
+
+def unload_soundfonts():
+    with _synths_lock:
+        for synth, _, _ in _synths.values():
+            synth.delete()
+        for idle in _stream_synths.values():
+            for synth, _ in idle:
+                synth.delete()
+        _synths.clear()
+        _stream_synths.clear()
+
+
+def _reset(synth, sfid):
+    if hasattr(synth, 'system_reset'):
+        synth.system_reset()
+        return
+    for channel in range(16):
+        synth.cc(channel, 123, 0)
+        synth.cc(channel, 121, 0)
+        if channel != 9:
+            synth.program_select(channel, sfid, 0, 0)
+
+
+def _send(synth, msg):
+    if msg.type == 'note_on':
+        if msg.velocity:
+            synth.noteon(msg.channel, msg.note, msg.velocity)
+        else:
+            synth.noteoff(msg.channel, msg.note)
+    elif msg.type == 'note_off':
+        synth.noteoff(msg.channel, msg.note)
+    elif msg.type == 'control_change':
+        synth.cc(msg.channel, msg.control, msg.value)
+    elif msg.type == 'program_change':
+        synth.program_change(msg.channel, msg.program)
+    elif msg.type == 'pitchwheel':
+        synth.pitch_bend(msg.channel, msg.pitch)
+
+
+@contextmanager
+def midi_path(midi):
+    # midi is a path or the MIDI bytes themselves; bytes are only written out for the fluidsynth CLI
+    if not isinstance(midi, (bytes, bytearray)):
+        yield midi
+        return
+    fd, midi_file = tempfile.mkstemp(suffix='.mid')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(midi)
+        yield midi_file
+    finally:
+        os.remove(midi_file)
+
+
+def midi_events(midi_file):
+    # (seconds from start, message) for every channel message, tempo changes already applied by mido.
+    # midi_file may also be the MIDI bytes.
+    seconds = 0.0
+    if isinstance(midi_file, (bytes, bytearray)):
+        midi = mido.MidiFile(file=io.BytesIO(midi_file))
+    else:
+        midi = mido.MidiFile(midi_file)
+    for msg in midi:
+        seconds += msg.time
+        if not msg.is_meta:
+            yield seconds, msg
+
+
+def render_midi_to_array(midi_file, soundfont, sample_rate=SAMPLE_RATE, tail_seconds=0.0):
+    # Renders straight into an int16 (frames, 2) buffer with a resident SoundFont, no WAV round-trip
+    synth, sfid, lock = get_synth(soundfont, sample_rate)
+    chunks = []
+    rendered = 0
+    with lock:
+        _reset(synth, sfid)
+        end = 0.0
+        for seconds, msg in midi_events(midi_file):
+            frame = int(round(seconds * sample_rate))
+            if frame > rendered:
+                chunks.append(synth.get_samples(frame - rendered))
+                rendered = frame
+            _send(synth, msg)
+            end = seconds
+        remaining = int(round((end + tail_seconds) * sample_rate)) - rendered
+        if remaining > 0:
+            chunks.append(synth.get_samples(remaining))
+    if not chunks:
+        return np.zeros((0, CHANNELS), dtype=np.int16)
+    return np.concatenate(chunks).astype(np.int16, copy=False).reshape(-1, CHANNELS)
+
+
+def stream_events_to_pcm(events, soundfont, sample_rate=SAMPLE_RATE, block_frames=SAMPLE_RATE, tail_seconds=0.0):
+    # events: time-ordered (seconds, note_on, channel, note, velocity). Yields int16 (frames, 2)
+    # blocks of at most block_frames. The generator renders on a pooled synth of its own, so a consumer that
+    # stops reading for a while holds up nobody else.
+    with stream_synth(soundfont, sample_rate) as (synth, sfid):
+        _reset(synth, sfid)
+        rendered = 0
+        end = 0.0
+        for seconds, note_on, channel, note, velocity in events:
+            frame = int(round(seconds * sample_rate))
+            while rendered < frame:
+                n = min(block_frames, frame - rendered)
+                yield synth.get_samples(n).astype(np.int16, copy=False).reshape(-1, CHANNELS)
+                rendered += n
+            if note_on:
+                synth.noteon(channel, note, velocity)
+            else:
+                synth.noteoff(channel, note)
+            end = seconds
+        last = int(round((end + tail_seconds) * sample_rate))
+        while rendered < last:
+            n = min(block_frames, last - rendered)
+            yield synth.get_samples(n).astype(np.int16, copy=False).reshape(-1, CHANNELS)
+            rendered += n
+
+
+def stream_midi_with_subprocess(midi_file, soundfont, sample_rate=SAMPLE_RATE, block_frames=SAMPLE_RATE):
+    # Fallback streaming: the fluidsynth CLI renders to a temporary WAV that is then read block by block
+    fd, wav_file = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        with midi_path(midi_file) as path:
+            subprocess.run(['fluidsynth', '-ni', soundfont, path, '-F', wav_file, '-r', str(sample_rate)],
+                           check=True, stdout=subprocess.DEVNULL)
+        with wave.open(wav_file, 'rb') as f:
+            channels = f.getnchannels()
+            while True:
+                frames = f.readframes(block_frames)
+                if not frames:
+                    break
+                yield np.frombuffer(frames, dtype='<i2').reshape(-1, channels)
+    finally:
+        os.remove(wav_file)
+
+
+def render_midi_with_subprocess(midi_file, soundfont, sample_rate=SAMPLE_RATE):
+    # Fallback through the fluidsynth command line; returns the same int16 (frames, 2) buffer
+    from pydub import AudioSegment
+
+    fd, wav_file = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+    try:
+        with midi_path(midi_file) as path:
+            subprocess.run(['fluidsynth', '-ni', soundfont, path, '-F', wav_file, '-r', str(sample_rate)],
+                           check=True, stdout=subprocess.DEVNULL)
+        audio = AudioSegment.from_wav(wav_file)
+    finally:
+        os.remove(wav_file)
+    return audio_segment_to_array(audio)
+
+
+def render_midi_to_pcm(midi_file, soundfont, sample_rate=SAMPLE_RATE):
+    if in_process_available():
+        return render_midi_to_array(midi_file, soundfont, sample_rate)
+    return render_midi_with_subprocess(midi_file, soundfont, sample_rate)
+
+
+def array_to_audio_segment(samples, sample_rate=SAMPLE_RATE):
+    from pydub import AudioSegment
+
+    samples = np.ascontiguousarray(samples, dtype=np.int16)
+    return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=sample_rate, channels=samples.shape[1])
+
+
+def audio_segment_to_array(audio):
+    audio = audio.set_sample_width(2)
+    samples = np.frombuffer(audio.raw_data, dtype=np.int16)
+    return samples.reshape(-1, audio.channels)
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+from .model_bundle import BUNDLE_EXTENSION, read_bundle, read_bundle_header, write_bundle
+from .model_registry import MODEL_SUFFIX
+from .numpy_model import model_arrays
+from .paths import DATA_DIR, data_path
+from .transition_table import CONTEXT_LENGTH
+
+CORPUS_DIR = data_path('ai_models_generation')
+CORPUS_SUFFIX = '_chord_progressions.txt'
+NORMALIZATION_MAP = {
+    'A#': 'Bb', 'C#': 'Db', 'D#': 'Eb', 'F#': 'Gb', 'G#': 'Ab',
+    'A#m': 'Bbm', 'C#m': 'Dbm', 'D#m': 'Ebm', 'F#m': 'Gbm', 'G#m': 'Abm'
+}
+TRAINING_DEFAULTS = {
+    'epochs': 80,
+    'batch_size': 32,
+    'patience': 8,
+    'shuffle_buffer': 10000,
+    'cache': '',
+    'learning_rate': None,
+}
+# Fine-tuning only sees the new progressions, so it runs shorter and slower to keep what the model knows
+FINE_TUNE_DEFAULTS = {**TRAINING_DEFAULTS, 'epochs': 10, 'patience': 3, 'learning_rate': 3e-4}
+
+
+def normalize_chord_name(chord_name):
+    return NORMALIZATION_MAP.get(chord_name, chord_name)
+
+
+def discover_corpora(corpus_dir=CORPUS_DIR):
+    # {mood: path} for every <mood>_chord_progressions.txt
+    return {filename[:-len(CORPUS_SUFFIX)]: os.path.join(corpus_dir, filename)
+            for filename in sorted(os.listdir(corpus_dir)) if filename.endswith(CORPUS_SUFFIX)}
+
+
+def corpus_lines(corpus_file, skip_lines=0):
+    # The lines as tf.data.TextLineDataset reads them, empty ones included
+    with open(corpus_file) as f:
+        for i, line in enumerate(f):
+            if i >= skip_lines:
+                yield line.rstrip('\n')
+
+
+def corpus_fingerprint(corpus_file, num_lines):
+    digest = hashlib.sha256()
+    for i, line in enumerate(corpus_lines(corpus_file)):
+        if i >= num_lines:
+            break
+        digest.update(line.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+
+def count_lines(corpus_file):
+    return sum(1 for _ in corpus_lines(corpus_file))
+
+
+def count_windows(corpus_file, skip_lines=0):
+    return sum(max(0, len(line.split(' ')) - CONTEXT_LENGTH) for line in corpus_lines(corpus_file, skip_lines) if line)
+
+
+def extend_vocabulary(vocabulary, corpus_file, skip_lines=0):
+    # Append-only: chords keep the id they already have and chords not seen before are added in sorted order,
+    # so the same inputs always give the same ids and retraining never renumbers a chord
+    known = set(vocabulary)
+    new = set()
+    for line in corpus_lines(corpus_file, skip_lines):
+        if line:
+            new.update(normalize_chord_name(chord) for chord in line.split(' '))
+    return list(vocabulary) + sorted(new - known)
+
+
+def load_vocabulary(model_name):
+    # Chord names in id order from an existing model, or [] when there is none
+    if os.path.exists(f'{model_name}{BUNDLE_EXTENSION}'):
+        return read_bundle_header(f'{model_name}{BUNDLE_EXTENSION}')['vocabulary']
+    if os.path.exists(f'{model_name}_int_to_chord.pkl'):
+        with open(f'{model_name}_int_to_chord.pkl', 'rb') as f:
+            int_to_chord = pickle.load(f)
+        return [int_to_chord[i] for i in range(len(int_to_chord))]
+    return []
+
+
+def load_training_state(model_name):
+    # How much of its corpus a model was trained on, recorded in its bundle's metadata
+    if not os.path.exists(f'{model_name}{BUNDLE_EXTENSION}'):
+        return {}
+    return read_bundle_header(f'{model_name}{BUNDLE_EXTENSION}')['metadata'].get('training', {})
+
+
+def load_weights(model_name):
+    # The weight arrays of an existing model, by the names numpy_model.model_arrays uses
+    if os.path.exists(f'{model_name}{BUNDLE_EXTENSION}'):
+        _, arrays = read_bundle(f'{model_name}{BUNDLE_EXTENSION}')
+        return {name: np.array(value) for name, value in arrays.items()}
+    if os.path.exists(f'{model_name}.npz'):
+        with np.load(f'{model_name}.npz') as data:
+            return {name: data[name] for name in data.files}
+    import tensorflow as tf
+    return model_arrays(tf.keras.models.load_model(f'{model_name}.h5'))
+
+
+def extend_weights(arrays, num_chords, rng=None):
+    # Keras weight list for create_model(num_chords), with new embedding rows and output columns for chords
+    # the model has never seen. New outputs start at the lowest existing bias so they begin improbable.
+    rng = np.random.default_rng() if rng is None else rng
+    embeddings, dense_kernel, dense_bias = arrays['embeddings'], arrays['dense_kernel'], arrays['dense_bias']
+    added = num_chords - embeddings.shape[0]
+    if added < 0:
+        raise ValueError("The vocabulary can only grow")
+    embeddings = np.concatenate([embeddings, rng.uniform(-0.05, 0.05, (added, embeddings.shape[1]))])
+    dense_kernel = np.concatenate([dense_kernel, rng.uniform(-0.05, 0.05, (dense_kernel.shape[0], added))], axis=1)
+    dense_bias = np.concatenate([dense_bias, np.full(added, dense_bias.min())])
+    weights = [embeddings.astype(np.float32)]
+    for n in range(int(arrays['num_lstm'])):
+        weights += [arrays[f'lstm_{n}_kernel'], arrays[f'lstm_{n}_recurrent_kernel'], arrays[f'lstm_{n}_bias']]
+    return weights + [dense_kernel.astype(np.float32), dense_bias.astype(np.float32)]
+
+
+def window_dataset(corpus_file, chord_to_int, batch_size=32, shuffle_buffer=10000, cache='', skip_lines=0):
+    # (3 chord ids, next chord id) pairs with sparse labels, streamed from the text file. cache='' keeps
+    # the windows in memory after the first epoch; a path caches them on disk for corpora that don't fit.
+    import tensorflow as tf
+
+    aliases = [alias for alias, chord in NORMALIZATION_MAP.items() if chord in chord_to_int and alias not in chord_to_int]
+    keys = list(chord_to_int) + aliases
+    values = [chord_to_int[normalize_chord_name(key)] for key in keys]
+    lookup = tf.lookup.StaticHashTable(tf.lookup.KeyValueTensorInitializer(keys, tf.constant(values, tf.int64)), -1)
+
+    def windows(line):
+        ids = lookup.lookup(tf.strings.split(line, ' '))
+        return tf.data.Dataset.from_tensor_slices(tf.signal.frame(ids, CONTEXT_LENGTH + 1, 1))
+
+    dataset = (tf.data.TextLineDataset(corpus_file)
+               .skip(skip_lines)
+               .filter(lambda line: tf.strings.length(line) > 0)
+               .interleave(windows, num_parallel_calls=tf.data.AUTOTUNE)
+               .map(lambda window: (window[:CONTEXT_LENGTH], window[CONTEXT_LENGTH]), num_parallel_calls=tf.data.AUTOTUNE)
+               .cache(cache)
+               .apply(tf.data.experimental.assert_cardinality(count_windows(corpus_file, skip_lines))))
+    return dataset.shuffle(shuffle_buffer).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+def create_model(num_unique_chords, learning_rate=None):
+    # The architecture of ai_models_generation/*_model.py, with sparse labels instead of one-hot rows
+    import tensorflow as tf
+    from tensorflow.keras.layers import LSTM, Dense, Dropout, Embedding
+
+    model = tf.keras.Sequential([
+        tf.keras.Input(shape=(CONTEXT_LENGTH,)),
+        Embedding(input_dim=num_unique_chords, output_dim=100),
+        LSTM(100, return_sequences=True),
+        Dropout(0.2),
+        LSTM(100),
+        Dense(num_unique_chords, activation='softmax')
+    ])
+    optimizer = tf.keras.optimizers.Adam(learning_rate) if learning_rate else 'adam'
+    model.compile(optimizer=optimizer, loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def save_model(model, vocabulary, model_name, training_state):
+    # The files the program loads: .h5 + both pickles as before, plus the .npz and .mtm exports
+    chord_to_int = {chord: i for i, chord in enumerate(vocabulary)}
+    int_to_chord = dict(enumerate(vocabulary))
+    model.save(f'{model_name}.h5')
+    with open(f'{model_name}_chord_to_int.pkl', 'wb') as f:
+        pickle.dump(chord_to_int, f)
+    with open(f'{model_name}_int_to_chord.pkl', 'wb') as f:
+        pickle.dump(int_to_chord, f)
+    arrays = model_arrays(model)
+    np.savez(f'{model_name}.npz', **arrays)
+    write_bundle(f'{model_name}{BUNDLE_EXTENSION}', arrays, vocabulary,
+                 {'source': f'{os.path.basename(model_name)}.h5', 'context_length': CONTEXT_LENGTH,
+                  'training': training_state})
+    # A prebuilt transition table holds the old model's predictions; it is rebuilt from the new
+    # weights on first use (or ahead of time with python -m makethemusic.transition_table)
+    try:
+        os.remove(f'{model_name}_table.npz')
+    except FileNotFoundError:
+        pass
+
+
+def _fit(model, dataset, checkpoint_dir, options, verbose):
+    import tensorflow as tf
+
+    callbacks = [
+        # Saves the model and optimizer after every epoch and restores them when a run is restarted
+        tf.keras.callbacks.BackupAndRestore(os.path.join(checkpoint_dir, 'backup')),
+        tf.keras.callbacks.EarlyStopping(monitor='loss', patience=options['patience'], min_delta=1e-4,
+                                         restore_best_weights=True),
+    ]
+    history = model.fit(dataset, epochs=options['epochs'], callbacks=callbacks, verbose=verbose, shuffle=False)
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(checkpoint_dir))
+    except OSError:
+        pass
+    return history.history['loss']
+
+
+def _set_threads(threads):
+    import tensorflow as tf
+
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+
+
+def train_mood(mood, corpus_file, output_dir=DATA_DIR, checkpoint_dir=None, threads=None, verbose=1, **options):
+    # Trains from scratch on the whole corpus. Chord ids of an existing model in output_dir are kept.
+    options = {**TRAINING_DEFAULTS, **options}
+    _set_threads(threads)
+    model_name = os.path.join(output_dir, f'{mood}{MODEL_SUFFIX}')
+    checkpoint_dir = os.path.join(checkpoint_dir or os.path.join(output_dir, 'checkpoints'), mood)
+
+    vocabulary = extend_vocabulary(load_vocabulary(model_name), corpus_file)
+    chord_to_int = {chord: i for i, chord in enumerate(vocabulary)}
+    dataset = window_dataset(corpus_file, chord_to_int, options['batch_size'], options['shuffle_buffer'],
+                             options['cache'])
+    model = create_model(len(vocabulary), options['learning_rate'])
+    losses = _fit(model, dataset, checkpoint_dir, options, verbose)
+
+    num_lines = count_lines(corpus_file)
+    save_model(model, vocabulary, model_name,
+               {'corpus_lines': num_lines, 'corpus_sha256': corpus_fingerprint(corpus_file, num_lines)})
+    return {'mood': mood, 'model': model_name, 'chords': len(vocabulary), 'epochs': len(losses),
+            'loss': round(min(losses), 4)}
+
+
+def fine_tune_mood(mood, corpus_file, output_dir=DATA_DIR, data_file=None, checkpoint_dir=None, threads=None,
+                   verbose=1, **options):
+    # Continues training the existing model on new progressions only: the corpus lines added since it was
+    # last trained, or every line of data_file. New chords are appended to the vocabulary and get fresh
+    # embedding rows and output columns; all other weights start from the existing model.
+    options = {**FINE_TUNE_DEFAULTS, **options}
+    model_name = os.path.join(output_dir, f'{mood}{MODEL_SUFFIX}')
+    old_vocabulary = load_vocabulary(model_name)
+    if not old_vocabulary:
+        raise ValueError(f"There is no trained {mood} model in {output_dir} to fine-tune")
+    state = load_training_state(model_name)
+    if data_file is None:
+        trained_lines = state.get('corpus_lines')
+        if trained_lines is None or corpus_fingerprint(corpus_file, trained_lines) != state.get('corpus_sha256'):
+            raise ValueError(f"The {mood} model was not trained on the start of {corpus_file}; "
+                             f"retrain it or pass the new progressions as a separate file")
+        data_file, skip_lines = corpus_file, trained_lines
+    else:
+        skip_lines = 0
+
+    result = {'mood': mood, 'model': model_name, 'chords': len(old_vocabulary), 'epochs': 0, 'loss': None}
+    if not count_windows(data_file, skip_lines):
+        return result
+    _set_threads(threads)
+    checkpoint_dir = os.path.join(checkpoint_dir or os.path.join(output_dir, 'checkpoints'), f'{mood}-fine-tune')
+
+    vocabulary = extend_vocabulary(old_vocabulary, data_file, skip_lines)
+    chord_to_int = {chord: i for i, chord in enumerate(vocabulary)}
+    dataset = window_dataset(data_file, chord_to_int, options['batch_size'], options['shuffle_buffer'],
+                             options['cache'], skip_lines)
+    model = create_model(len(vocabulary), options['learning_rate'])
+    model.set_weights(extend_weights(load_weights(model_name), len(vocabulary)))
+    losses = _fit(model, dataset, checkpoint_dir, options, verbose)
+
+    if data_file == corpus_file:
+        num_lines = count_lines(corpus_file)
+        state = {'corpus_lines': num_lines, 'corpus_sha256': corpus_fingerprint(corpus_file, num_lines)}
+    save_model(model, vocabulary, model_name, state)
+    return {**result, 'chords': len(vocabulary), 'epochs': len(losses), 'loss': round(min(losses), 4)}
+
+
+def train_moods(moods=None, corpus_dir=CORPUS_DIR, output_dir=DATA_DIR, jobs=None, fine_tune=False, **options):
+    # Each mood trains in its own process; the CPU threads are split between them
+    corpora = discover_corpora(corpus_dir)
+    moods = moods or list(corpora)
+    missing = [mood for mood in moods if mood not in corpora]
+    if missing:
+        raise ValueError(f"No {CORPUS_SUFFIX} corpus for: {', '.join(missing)}")
+    jobs = max(1, min(jobs or len(moods), len(moods)))
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    train = fine_tune_mood if fine_tune else train_mood
+
+    os.makedirs(output_dir, exist_ok=True)
+    if jobs == 1:
+        return [train(mood, corpora[mood], output_dir, threads=threads, **options) for mood in moods]
+    # spawn: TensorFlow must not be inherited half-initialised through fork
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=get_context('spawn')) as pool:
+        futures = [pool.submit(train, mood, corpora[mood], output_dir, threads=threads, verbose=2, **options)
+                   for mood in moods]
+        return [future.result() for future in futures]
@@ -0,0 +1,138 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+CONTEXT_LENGTH = 3
+# Softmax rows are never exactly 0, so without a threshold the walk reaches all V**3 contexts. Transitions
+# below MIN_PROBABILITY are not followed, and the table stops growing at MAX_TABLE_BYTES (about 40k rows for
+# 100 chords); anything left out goes through the model and the LRU cache instead.
+MIN_PROBABILITY = 1e-4
+MAX_TABLE_BYTES = 16 * 2**20
+
+
+def encode_contexts(contexts, num_chords):
+    contexts = np.asarray(contexts, dtype=np.int64)
+    keys = np.zeros(contexts.shape[0], dtype=np.int64)
+    for t in range(contexts.shape[1]):
+        keys = keys * num_chords + contexts[:, t]
+    return keys
+
+
+def decode_contexts(keys, num_chords):
+    contexts = np.zeros((len(keys), CONTEXT_LENGTH), dtype=np.int64)
+    keys = np.array(keys, dtype=np.int64)
+    for t in range(CONTEXT_LENGTH - 1, -1, -1):
+        contexts[:, t] = keys % num_chords
+        keys //= num_chords
+    return contexts
+
+
+class TransitionTable:
+    # Precomputed softmax rows for 3-chord contexts, sorted by encoded context key.
+    # Contexts missing from the table are run through the model and kept in a small LRU cache.
+    # predict() has the same signature as the model, so the table can stand in for it when sampling.
+    # One table is shared by every thread sampling its mood, so the cache is guarded by a lock.
+
+    def __init__(self, keys, probabilities, model=None, cache_size=4096):
+        self.keys = keys
+        self.probabilities = probabilities
+        self.num_chords = probabilities.shape[1]
+        self.model = model
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _fallback(self, key, context):
+        with self._cache_lock:
+            row = self._cache.get(key)
+            if row is not None:
+                self._cache.move_to_end(key)
+                return row
+        if self.model is None:
+            raise KeyError(f"Context {context.tolist()} is not in the transition table")
+        row = self.model.predict(context[np.newaxis, :], verbose=0)[0].astype(self.probabilities.dtype)
+        with self._cache_lock:
+            self._cache[key] = row
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return row
+
+    def predict(self, x, verbose=0):
+        x = np.asarray(x, dtype=np.int64)
+        keys = encode_contexts(x, self.num_chords)
+        positions = np.searchsorted(self.keys, keys)
+        positions = np.minimum(positions, len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        rows = self.probabilities[positions]
+        for i in np.flatnonzero(~found):
+            rows[i] = self._fallback(int(keys[i]), x[i])
+        return rows
+
+
+def build_transition_table(model, num_chords, min_probability=MIN_PROBABILITY, max_bytes=MAX_TABLE_BYTES,
+                           batch_size=8192, dtype=np.float32):
+    # Breadth-first walk from every zero-padded start context [0, 0, s]; a successor context is
+    # only followed when the model gives its transition more than min_probability. The walk stops once
+    # the table holds max_bytes of probabilities, so the contexts closest to a start are the ones kept.
+    max_contexts = max(1, max_bytes // (num_chords * np.dtype(dtype).itemsize))
+    frontier = encode_contexts([[0, 0, s] for s in range(num_chords)], num_chords)
+    frontier = np.unique(frontier)
+    seen_keys = []
+    seen_rows = []
+    visited = np.zeros(0, dtype=np.int64)
+
+    while len(frontier) and len(visited) < max_contexts:
+        frontier = frontier[:max_contexts - len(visited)]
+        visited = np.union1d(visited, frontier)
+        successors = []
+        for start in range(0, len(frontier), batch_size):
+            keys = frontier[start:start + batch_size]
+            contexts = decode_contexts(keys, num_chords)
+            rows = model.predict(contexts, verbose=0).astype(dtype)
+            seen_keys.append(keys)
+            seen_rows.append(rows)
+
+            parents, next_ids = np.nonzero(rows > min_probability)
+            shifted = np.concatenate([contexts[parents, 1:], next_ids[:, np.newaxis]], axis=1)
+            successors.append(encode_contexts(shifted, num_chords))
+        frontier = np.setdiff1d(np.concatenate(successors), visited)
+
+    keys = np.concatenate(seen_keys)
+    rows = np.concatenate(seen_rows)
+    order = np.argsort(keys)
+    return TransitionTable(keys[order], rows[order], model)
+
+
+def save_transition_table(table, npz_file):
+    np.savez(npz_file, keys=table.keys, probabilities=table.probabilities)
+
+
+def load_transition_table(npz_file, model=None, num_chords=None):
+    # num_chords: the vocabulary size of the model the table must match; contexts are encoded with it
+    num_chords = num_chords or getattr(model, 'num_chords', None)
+    with np.load(npz_file) as data:
+        if num_chords is not None and data['probabilities'].shape[1] != num_chords:
+            raise ValueError(f"{npz_file} was built for {data['probabilities'].shape[1]} chords, "
+                             f"the model has {num_chords}")
+        return TransitionTable(data['keys'], data['probabilities'], model)
+
+
+if __name__ == '__main__':
+    # python -m makethemusic.transition_table happy sad  ->  happy_model_table.npz, sad_model_table.npz
+    import os
+
+    from . import model_registry
+    from .paths import DATA_DIR
+
+    model_registry.register_model_dir()
+    for mood in sys.argv[1:] or model_registry.available_moods():
+        model, chord_to_int, _ = model_registry.get_model(mood)
+        table = build_transition_table(model, len(chord_to_int))
+        save_transition_table(table, os.path.join(DATA_DIR, f'{mood}{model_registry.MODEL_SUFFIX}_table.npz'))
+        print(f"{mood}: {len(table)} contexts")